@@ -1,6 +1,6 @@
-from .bandname import BandName
-
-
 async def setup(bot):
+    # BandName is imported here rather than at module level so the prefilter
+    # can be imported (and benchmarked) without redbot and discord.py
+    from .bandname import BandName
     cog = BandName(bot)
     await bot.add_cog(cog)
@@ -1,4 +1,5 @@
 import re
+from asyncio import CancelledError, get_running_loop, sleep
 from random import choice, random
 from typing import Union
 
@@ -7,6 +8,33 @@ from redbot.core import Config, checks, commands
 from redbot.core.bot import Red
 from redbot.core.commands import Context
 
+from .prefilter import compile_exclusion, get_prefilter
+
+
+# How long p_mod changes sit in memory before they're written to Config. Every
+# message a guild sends in that time gets written in one go
+FLUSH_DELAY = 30
+
+
+class GuildState(object):
+    """
+        A guild's bandname settings and probability, held in memory so
+        on_message never has to wait on Config. p_mod changes on nearly every
+        message, so it's written back in batches; everything else only
+        changes through commands, which write it straight through.
+    """
+
+    def __init__(self, data):
+        self.disabled = data["disabled"]
+        self.channel_blacklist = set(data["channel_blacklist"])
+        self.p_mod = data["p_mod"]
+        self.p_scale = data["p_scale"]
+        self.set_exclusions(data["exclusions"])
+
+    def set_exclusions(self, exclusions):
+        self.exclusions = list(exclusions)
+        self.prefilter = get_prefilter(tuple(self.exclusions))
+
 
 class BandName(commands.Cog):
     """ Fun cog that randomly turns user messages into band names. """
@@ -29,56 +57,104 @@ class BandName(commands.Cog):
             "p_mod": 0,
             # int of probability scaling
             "p_scale": 0.5,
+            # list of regex patterns; messages matching any of them are never band names
+            "exclusions": [],
         }
         self.config.register_global(**self.default_config)
         self.config.register_guild(**self.default_config_guild)
-        self.blacklists = ["http", "www", "@", '#']
-        self.blacklist_regex = re.compile(r"^(.\!\w|[^\w])")
+        # guild ID -> GuildState, loaded in cog_load
+        self._guilds = {}
+        self._genres = list(self.default_config["genres"])
+        # Guilds whose p_mod has changed since the last flush
+        self._dirty = set()
+        self._flush_task = None
+
+    async def cog_load(self):
+        self._genres = await self.config.genres()
+        for guild_id, data in (await self.config.all_guilds()).items():
+            state = self._guilds[guild_id] = GuildState(data)
+            if state.prefilter.invalid:
+                print(f"[BANDNAME] skipping invalid exclusions for guild {guild_id}: {state.prefilter.invalid}")
+
+    async def cog_unload(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._flush()
+
+    def _state(self, guild):
+        state = self._guilds.get(guild.id)
+        if state is None:
+            # Never changed anything, so it's all defaults
+            state = self._guilds[guild.id] = GuildState(self.default_config_guild)
+        return state
+
+    def _set_p_mod(self, guild, state, p_mod):
+        state.p_mod = p_mod
+        self._dirty.add(guild.id)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await sleep(FLUSH_DELAY)
+        except CancelledError:
+            return
+        self._flush_task = None
+        # Anything that didn't save gets another go after another delay
+        if await self._flush():
+            self._schedule_flush()
+
+    async def _flush(self):
+        """
+            Writes every p_mod that changed since the last flush to Config.
+            Returns the guild IDs that couldn't be written, which stay dirty.
+        """
+        dirty, self._dirty = self._dirty, set()
+        failed = set()
+        for guild_id in dirty:
+            try:
+                await self.config.guild_from_id(guild_id).p_mod.set(self._guilds[guild_id].p_mod)
+            except Exception as error:
+                print(f"[BANDNAME] couldn't save p_mod for guild {guild_id}: {error}")
+                failed.add(guild_id)
+        self._dirty |= failed
+        return failed
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        print('bandname bot triggered.')
         if message.author == self.bot.user:
-            print('ignoring messages from other bots')
             return
         if type(message.channel) != discord.TextChannel:
-            print('messages not coming from a normal text channel, ignoring')
             return
-        # TODO: reorder these so that the most common disqualifiers are checked first
-        # check for channel or server blacklisted, etc
-        guild_config = self.config.guild(message.guild)
+        # Everything up to the dice roll is in memory, cheapest checks first
+        state = self._state(message.guild)
         # check if the guild has this cog disabled completely
-        guild_disabled = await guild_config.disabled()
-        if guild_disabled:
+        if state.disabled:
             return
         # check if the guild has the channel the message came from blacklisted
-        channel_blacklist = await guild_config.channel_blacklist()
-        if message.channel.id in channel_blacklist:
+        if message.channel.id in state.channel_blacklist:
             return
-        # roughshod list that should exclude urls, mentions, channels
-        if any(x in self.blacklists for x in message.content) or self.blacklist_regex.match(message.content):
-            print('skipping due to blacklist in bandname trigger message')
+        # make sure the message is the right length and isn't a url, mention,
+        # channel, command or anything else the guild has excluded
+        if not state.prefilter(message.content):
             return
-        # make sure the message is of the appropriate length
-        if 1 < len(message.content.split()) < 7:
-            print('about to actually try to trigger bandname')
-            # actually do the deal
-            p_mod = await guild_config.p_mod()
-            roll = random()*1000
-            if roll+p_mod > 999:
-                print('bandname message HIT')
-                # pick a random genre
-                genres = await self.config.genres()
-                genre = choice(genres)
-                # send the message
-                band = message.content.strip()
-                await message.channel.send(f"\"{band}\" is the name of my new {genre} band")
-                await guild_config.p_mod.set(0)
-            else:
-                print('bandname message MISS')
-                p_scale = await guild_config.p_scale()
-                await guild_config.p_mod.set(p_mod+p_scale)
-
+        # actually do the deal
+        roll = random()*1000
+        if roll+state.p_mod > 999:
+            # pick a random genre
+            genre = choice(self._genres)
+            # p_mod goes back to 0 before we send, so a burst of messages
+            # can't all hit while we're waiting on Discord
+            self._set_p_mod(message.guild, state, 0)
+            # send the message
+            band = message.content.strip()
+            await message.channel.send(f"\"{band}\" is the name of my new {genre} band")
+        else:
+            self._set_p_mod(message.guild, state, state.p_mod+state.p_scale)
 
     @commands.group()
     async def bandname(self, ctx: Context):
@@ -94,13 +170,17 @@ class BandName(commands.Cog):
     @bandname_set.command('pmod')
     async def bandname_set_pmod(self, ctx: Context, new_pmod: float = None):
         """View and set your probability modifier."""
-        pmod = await self.config.guild(ctx.guild).p_mod()
+        state = self._state(ctx.guild)
+        # The in-memory one is the current one, Config may be a flush behind
+        pmod = state.p_mod
         if not new_pmod:
             await ctx.send(f"P_mod for {ctx.guild.name} is {pmod}")
         else:
             if pmod == new_pmod:
                 await ctx.send(f"P_mod for {ctx.guild.name} is already {pmod}")
             else:
+                state.p_mod = new_pmod
+                self._dirty.discard(ctx.guild.id)
                 await self.config.guild(ctx.guild).p_mod.set(new_pmod)
                 pmod = await self.config.guild(ctx.guild).p_mod()
                 await ctx.send(f"P_mod for {ctx.guild.name} is now {pmod}")
@@ -117,6 +197,7 @@ class BandName(commands.Cog):
             else:
                 await self.config.guild(ctx.guild).p_scale.set(new_pscale)
                 pscale = await self.config.guild(ctx.guild).p_scale()
+                self._state(ctx.guild).p_scale = pscale
                 await ctx.send(f"P_scale for {ctx.guild.name} is now {pscale}")
 
     @bandname_set.command('toggle')
@@ -125,6 +206,7 @@ class BandName(commands.Cog):
         disabled = await self.config.guild(ctx.guild).disabled()
         await self.config.guild(ctx.guild).disabled.set(not disabled)
         disabled = await self.config.guild(ctx.guild).disabled()
+        self._state(ctx.guild).disabled = disabled
         if disabled:
             status = "disabled"
         else:
@@ -151,12 +233,14 @@ class BandName(commands.Cog):
                         genres.append(genre)
                         await self.config.genres.set(genres)
                         genres = await self.config.genres()
+                        self._genres = genres
                         await ctx.send(f"New genre list: {repr(genres)}")
                 elif command == "del":
                     if genre in genres:
                         genres.remove(genre)
                         await self.config.genres.set(genres)
                         genres = await self.config.genres()
+                        self._genres = genres
                         await ctx.send(f"New genre list: {repr(genres)}")
                     else:
                         await ctx.send(f"{genre} was not found in the genre list!")
@@ -175,14 +259,48 @@ class BandName(commands.Cog):
                     channel_blacklist.append(channel.id)
                     await self.config.guild(ctx.guild).channel_blacklist.set(channel_blacklist)
                     channel_blacklist = await self.config.guild(ctx.guild).channel_blacklist()
+                    self._state(ctx.guild).channel_blacklist = set(channel_blacklist)
                     await ctx.send(f"New channel blacklist: {repr(channel_blacklist)}")
             elif command == "del":
                 if channel.id in channel_blacklist:
                     channel_blacklist.remove(channel.id)
                     await self.config.guild(ctx.guild).channel_blacklist.set(channel_blacklist)
                     channel_blacklist = await self.config.guild(ctx.guild).channel_blacklist()
+                    self._state(ctx.guild).channel_blacklist = set(channel_blacklist)
                     await ctx.send(f"New channel blacklist: {repr(channel_blacklist)}")
                 else:
                     await ctx.send(f"{channel.name} was not found in the blacklist!")
             elif command == "list":
                 await ctx.send(f"Current blacklist for {ctx.guild.name}: {repr([ctx.guild.get_channel(x) for x in channel_blacklist])}")
+
+    @bandname_set.command('exclude')
+    async def bandname_set_exclude(self, ctx: Context, command: str=None, *, pattern: str=None):
+        """Allows you to add, remove, and view regex patterns that stop a message from becoming a band name."""
+        exclusions = await self.config.guild(ctx.guild).exclusions()
+        if not command:
+            await ctx.send("Valid commands are 'add', 'del', and 'list'")
+        elif command == "list":
+            await ctx.send(f"Current exclusions for {ctx.guild.name}: {repr(exclusions)}")
+        elif not pattern:
+            await ctx.send("Please give me a pattern too.")
+        elif command == "add":
+            if pattern in exclusions:
+                await ctx.send(f"{pattern} is already excluded.")
+                return
+            try:
+                compile_exclusion(pattern)
+            except re.error as error:
+                await ctx.send(f"That's not a valid pattern: {error}")
+                return
+            exclusions.append(pattern)
+            await self.config.guild(ctx.guild).exclusions.set(exclusions)
+            self._state(ctx.guild).set_exclusions(exclusions)
+            await ctx.send(f"New exclusions: {repr(exclusions)}")
+        elif command == "del":
+            if pattern in exclusions:
+                exclusions.remove(pattern)
+                await self.config.guild(ctx.guild).exclusions.set(exclusions)
+                self._state(ctx.guild).set_exclusions(exclusions)
+                await ctx.send(f"New exclusions: {repr(exclusions)}")
+            else:
+                await ctx.send(f"{pattern} was not found in the exclusions!")
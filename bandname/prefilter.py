@@ -0,0 +1,59 @@
+import re
+from functools import lru_cache
+
+
+# Roughshod pattern that should exclude urls, mentions, channels
+BLACKLIST_REGEX = re.compile(r"https?://|\bwww\.|[@#]", re.IGNORECASE)
+# Messages that start with punctuation or look like a bot command
+LEADING_REGEX = re.compile(r"^(.\!\w|[^\w])")
+# Band names are 2 to 6 words long
+MIN_WORDS = 2
+MAX_WORDS = 6
+
+
+def compile_exclusion(pattern):
+    """Compiles one custom exclusion pattern the way the prefilter will use it. Raises re.error if it's no good."""
+    return re.compile(pattern, re.IGNORECASE)
+
+
+class Prefilter(object):
+    """
+        Decides whether a message could be a band name at all, before any
+        dice get rolled. Built once per set of custom exclusions, with the
+        cheapest rejections first: the leading-punctuation check only looks
+        at the start of the message, the word count stops splitting once
+        there are too many words, then the url/mention/channel blacklist is
+        one scan, and the guild's custom exclusions come last.
+
+        Custom patterns are compiled one by one rather than joined into one
+        regex, since joining them renumbers their groups and two of them
+        with the same group name can't be joined at all. Any that don't
+        compile (say, saved by an older Python) are skipped and listed in
+        invalid rather than taking the whole guild down.
+    """
+
+    def __init__(self, exclusions=()):
+        self.exclusions = tuple(exclusions)
+        self._custom = []
+        self.invalid = []
+        for pattern in self.exclusions:
+            try:
+                self._custom.append(compile_exclusion(pattern))
+            except re.error:
+                self.invalid.append(pattern)
+
+    def __call__(self, content):
+        if LEADING_REGEX.match(content):
+            return False
+        # One more split than we need is enough to tell it's too long
+        if not MIN_WORDS <= len(content.split(None, MAX_WORDS)) <= MAX_WORDS:
+            return False
+        if BLACKLIST_REGEX.search(content):
+            return False
+        return not any(exclusion.search(content) for exclusion in self._custom)
+
+
+@lru_cache(maxsize=256)
+def get_prefilter(exclusions=()):
+    """The Prefilter for a tuple of custom exclusions, shared by every guild that has the same ones."""
+    return Prefilter(exclusions)
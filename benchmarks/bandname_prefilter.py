@@ -0,0 +1,77 @@
+"""
+    Throughput benchmark for bandname's message prefilter.
+
+    Builds a large synthetic corpus of chat messages (short ones, long ones,
+    links, mentions, channel links and bot commands) and runs it through the
+    old eligibility check from on_message (character-by-character blacklist,
+    leading-punctuation regex, then a full split() for the word count) and
+    the compiled Prefilter, with and without custom exclusion patterns.
+    Run it from the repo root:
+
+        python benchmarks/bandname_prefilter.py [--messages 200000]
+"""
+
+import argparse
+import re
+import sys
+import time
+from os.path import abspath, dirname
+from random import Random
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from bandname.prefilter import Prefilter  # noqa: E402
+
+WORDS = "lol ok same wait what did you see that one yeah no idk brb the night dog".split()
+EXCLUSIONS = (r"\bbrb\b", r"^same\b", r"(.)\1{3,}")
+
+legacy_blacklists = ["http", "www", "@", '#']
+legacy_regex = re.compile(r"^(.\!\w|[^\w])")
+
+
+def legacy_eligible(content):
+    if any(x in legacy_blacklists for x in content) or legacy_regex.match(content):
+        return False
+    return 1 < len(content.split()) < 7
+
+
+def make_corpus(count, seed=0):
+    rng = Random(seed)
+    messages = []
+    for _ in range(count):
+        # Most chat is a few words, with a long tail of paragraphs
+        words = [rng.choice(WORDS) for _ in range(min(int(rng.expovariate(1/6))+1, 200))]
+        roll = rng.random()
+        if roll < 0.05:
+            words.insert(rng.randrange(len(words)+1), f"https://example.com/{rng.randint(0, 10**6)}")
+        elif roll < 0.10:
+            words.insert(rng.randrange(len(words)+1), f"<@!{rng.randint(10**17, 10**18)}>")
+        elif roll < 0.12:
+            words.insert(rng.randrange(len(words)+1), f"<#{rng.randint(10**17, 10**18)}>")
+        elif roll < 0.15:
+            words[0] = f"!{words[0]}"
+        messages.append(' '.join(words))
+    return messages
+
+
+def bench(label, eligible, messages):
+    start = time.perf_counter()
+    passed = sum(1 for content in messages if eligible(content))
+    elapsed = time.perf_counter() - start
+    print(f"{label:>26}: {len(messages)/elapsed:10.0f} messages/s, {passed} eligible")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    messages = make_corpus(args.messages)
+    print(f"{args.messages} synthetic messages")
+    bench("legacy", legacy_eligible, messages)
+    bench("prefilter", Prefilter(), messages)
+    bench("prefilter, 3 exclusions", Prefilter(EXCLUSIONS), messages)
+
+
+if __name__ == "__main__":
+    main()
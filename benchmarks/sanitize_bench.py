@@ -0,0 +1,98 @@
+"""
+    Throughput benchmark for weeedcog's message sanitizer.
+
+    Builds a large synthetic corpus of messages full of mentions, channel
+    links and custom emoji, then runs it through the old three-regex
+    sanitizer (applied twice per message, like _messages_to_comicdata used
+    to) and the single-pass one, cold and with its per-message cache warm.
+    Run it from the repo root:
+
+        python benchmarks/sanitize_bench.py [--messages 50000]
+"""
+
+import argparse
+import re
+import sys
+import time
+from os.path import abspath, dirname
+from random import Random
+from types import SimpleNamespace
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from weeedcog.sanitizer import Sanitizer, sanitize_text  # noqa: E402
+
+WORDS = "lol ok same wait what did you see that one yeah no idk brb".split()
+
+
+class FakeGuild(object):
+    def __init__(self, members, channels):
+        self.members = {id: SimpleNamespace(display_name=f"user{id}") for id in members}
+        self.channels = {id: SimpleNamespace(name=f"channel{id}") for id in channels}
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+    def get_role(self, id):
+        return None
+
+
+def legacy_sanitize(guild, text):
+    text = re.sub(re.compile(r"(?:<@!?)([0-9]+)(?:>)"),
+                  lambda m: guild.get_member(int(m.group(1))).display_name, text)
+    text = re.sub(re.compile(r"(?:<#)([0-9]+)(?:>)"),
+                  lambda m: f"#{guild.get_channel(int(m.group(1))).name}", text)
+    return re.sub(re.compile(r"(?:<a?)(\:[0-9a-zA-Z]+\:)(?:[0-9]+>)"), lambda m: m.group(1), text)
+
+
+def make_corpus(count, guild, seed=0):
+    rng = Random(seed)
+    members = list(guild.members)
+    channels = list(guild.channels)
+    messages = []
+    for id in range(count):
+        words = []
+        for _ in range(rng.randint(1, 30)):
+            roll = rng.random()
+            if roll < 0.05:
+                words.append(f"<@!{rng.choice(members)}>")
+            elif roll < 0.08:
+                words.append(f"<#{rng.choice(channels)}>")
+            elif roll < 0.12:
+                words.append(f"<:pog{rng.randint(0, 50)}:{rng.randint(10**17, 10**18)}>")
+            else:
+                words.append(rng.choice(WORDS))
+        messages.append(SimpleNamespace(id=id, edited_at=None, guild=guild, content=' '.join(words)))
+    return messages
+
+
+def bench(label, sanitize, messages):
+    start = time.perf_counter()
+    for message in messages:
+        sanitize(message)
+    elapsed = time.perf_counter() - start
+    print(f"{label:>22}: {len(messages)/elapsed:10.0f} messages/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    args = parser.parse_args()
+
+    guild = FakeGuild(members=range(1000, 1100), channels=range(2000, 2020))
+    messages = make_corpus(args.messages, guild)
+    print(f"{args.messages} synthetic messages")
+    # The old code sanitized every message twice: once as this_text and
+    # again as the next message's prev_text
+    bench("legacy (x2 per msg)", lambda m: [legacy_sanitize(m.guild, m.content) for _ in range(2)], messages)
+    bench("single pass", lambda m: sanitize_text(m.guild, m.content), messages)
+    sanitizer = Sanitizer(cache_size=args.messages)
+    bench("single pass, cold cache", lambda m: sanitizer.sanitize(guild, m), messages)
+    bench("single pass, warm cache", lambda m: sanitizer.sanitize(guild, m), messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+    Microbenchmark for weeedcog's TextWrapper.
+
+    Wraps the text of a batch of synthetic 80-message comics with the old
+    measure-every-word wrapper and with the shared FontMetrics cache, and
+    prints throughput for both. Run it from the repo root:
+
+        python benchmarks/textwrap_bench.py [--comics 50] [--font ComicBD.ttf]
+"""
+
+import argparse
+import sys
+import time
+import warnings
+from os.path import abspath, dirname, join
+from random import Random
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+from weeedcog.textwrapper import TextWrapper, wrap_many  # noqa: E402
+
+FONT_DIR = join(dirname(dirname(abspath(__file__))), "weeedcog", "data", "font")
+WORDS = (
+    "lol what the heck is this even about i cannot believe you did that "
+    "honestly same mood yeah no way dude that's wild okay but why though "
+    "weeed comic bot plz make it stop anyway brb getting snacks"
+).split()
+
+
+class LegacyTextWrapper(object):
+    """The wrapper as it was: a fresh ImageDraw and one textsize per word."""
+
+    def __init__(self, text, font, max_width):
+        self.text_lines = [
+            ' '.join([w.strip() for w in l.split(' ') if w])
+            for l in text.split('\n')
+            if l
+        ]
+        self.font = font
+        self.max_width = max_width
+        self.draw = ImageDraw.Draw(Image.new(mode='RGB', size=(100, 100)))
+        self.space_width = self.draw.textsize(text=' ', font=self.font)[0]
+
+    def wrapped_text(self):
+        wrapped_lines = []
+        buf = []
+        buf_width = 0
+        for line in self.text_lines:
+            for word in line.split(' '):
+                word_width = self.draw.textsize(text=word, font=self.font)[0]
+                expected_width = word_width if not buf else \
+                    buf_width + self.space_width + word_width
+                if expected_width <= self.max_width:
+                    buf_width = expected_width
+                    buf.append(word)
+                else:
+                    wrapped_lines.append(' '.join(buf))
+                    buf = [word]
+                    buf_width = word_width
+            if buf:
+                wrapped_lines.append(' '.join(buf))
+                buf = []
+                buf_width = 0
+        return '\n'.join(wrapped_lines)
+
+
+def make_comics(count, messages=80, seed=0):
+    rng = Random(seed)
+    return [
+        [' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 40))) for _ in range(messages)]
+        for _ in range(count)
+    ]
+
+
+def bench(label, wrap_comic, comics):
+    start = time.perf_counter()
+    for texts in comics:
+        wrap_comic(texts)
+    elapsed = time.perf_counter() - start
+    total = sum(len(texts) for texts in comics)
+    print(f"{label:>10}: {total/elapsed:10.0f} texts/s  {len(comics)/elapsed:8.1f} comics/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--comics", type=int, default=50)
+    parser.add_argument("--font", default="ComicBD.ttf")
+    parser.add_argument("--width", type=int, default=300)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    font = ImageFont.truetype(join(FONT_DIR, args.font), size=15)
+    comics = make_comics(args.comics)
+    print(f"{args.comics} comics x 80 messages, {args.font}")
+    bench("legacy", lambda texts: [LegacyTextWrapper(t, font, args.width).wrapped_text() for t in texts], comics)
+    bench("wrapper", lambda texts: [TextWrapper(t, font, args.width).wrapped_text() for t in texts], comics)
+    bench("wrap_many", lambda texts: wrap_many(texts, font, args.width), comics)
+
+
+if __name__ == "__main__":
+    main()
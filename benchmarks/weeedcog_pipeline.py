@@ -0,0 +1,325 @@
+"""
+    Benchmark suite for the weeedcog comic pipeline.
+
+    Builds synthetic conversations with fake guilds, members and messages (no
+    Discord connection needed) and times every stage a comic goes through:
+    sanitizing and grouping messages into comic data (what _layout_comic
+    does), wrapping, layout, drawing panels (one at a time and
+    --panel-threads at a time), assembling the whole comic with PIL
+    and, if NumPy is installed, the NumPy compositor, and encoding. Each
+    stage reports wall time, output size for the encoders, and how far it
+    pushes up peak RSS. Nearly all of a comic's memory is Pillow's, which
+    tracemalloc can't see, so every stage runs once more on its own in a
+    fresh process and we read that process's getrusage.
+
+    Run it from the repo root:
+
+        python benchmarks/weeedcog_pipeline.py                 # print results
+        python benchmarks/weeedcog_pipeline.py --save          # write a new baseline
+        python benchmarks/weeedcog_pipeline.py --compare       # fail on regressions
+
+    --compare exits non-zero if any stage got slower than the baseline by
+    more than --tolerance (and more than --min-delta-ms), or any output got
+    bigger, so it can gate CI. Stages the baseline doesn't have yet are
+    listed, so it's clear they aren't being checked.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from datetime import datetime, timedelta
+from os.path import abspath, dirname, join
+from random import Random
+from statistics import median
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PIL  # noqa: E402
+from PIL import Image  # noqa: E402
+from weeedcog.assets import get_asset_cache  # noqa: E402
+from weeedcog.encoder import ENCODING_MODES, encode_comic, stream_png  # noqa: E402
+from weeedcog.history import CachedMessage  # noqa: E402
+from weeedcog.layout import ComicEntry, TEXT_WIDTH, group_panels, layout_comic  # noqa: E402
+from weeedcog.compositor import HAVE_NUMPY  # noqa: E402
+from weeedcog.renderer import composite_comic, render_panels  # noqa: E402
+from weeedcog.sanitizer import Sanitizer  # noqa: E402
+from weeedcog.textwrapper import wrap_many  # noqa: E402
+
+DATAPATH = join(ROOT, "weeedcog", "data")
+BASELINE = join(ROOT, "benchmarks", "baselines", "weeedcog_pipeline.json")
+SIZES = (1, 10, 40, 80)
+CASES = ("chat", "long_text", "emoji")
+FONT = "ComicBD.ttf"
+BACKGROUND = "beach-paradise-beach-desktop.jpg"
+CHARS = ("Horse.png", "bird.png", "frog.png", "danbo.png", "hamster.png")
+
+WORDS = (
+    "lol what the heck is this even about i cannot believe you did that "
+    "honestly same mood yeah no way dude that's wild okay but why though"
+).split()
+EMOJI = ["\U0001F602", "\U0001F525", "\U0001F440", "❤️", "\U0001F914"]
+
+
+class FakeGuild(object):
+    def __init__(self, member_ids, channel_ids):
+        self.members = {id: SimpleNamespace(id=id, display_name=f"user{id}") for id in member_ids}
+        self.channels = {id: SimpleNamespace(id=id, name=f"channel{id}") for id in channel_ids}
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+    def get_role(self, id):
+        return None
+
+
+def make_messages(case, count, guild, seed=0):
+    rng = Random(seed)
+    authors = list(guild.members)[:len(CHARS)]
+    start = datetime(2020, 4, 20, 16, 20)
+    messages = []
+    for index in range(count):
+        if case == "long_text":
+            words = [rng.choice(WORDS) for _ in range(rng.randint(30, 90))]
+        elif case == "emoji":
+            words = []
+            for _ in range(rng.randint(3, 15)):
+                roll = rng.random()
+                if roll < 0.3:
+                    words.append(rng.choice(EMOJI))
+                elif roll < 0.5:
+                    words.append(f"<:pog{rng.randint(0, 9)}:{rng.randint(10**17, 10**18)}>")
+                elif roll < 0.6:
+                    words.append(f"<@!{rng.choice(authors)}>")
+                else:
+                    words.append(rng.choice(WORDS))
+        else:
+            words = [rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+        messages.append(CachedMessage(
+            id=index+1,
+            author_id=rng.choice(authors),
+            content=' '.join(words),
+            created_at=start+timedelta(seconds=index*5),
+            edited_at=None
+            ))
+    return messages
+
+
+def make_guild():
+    return FakeGuild(member_ids=range(1000, 1010), channel_ids=range(2000, 2005))
+
+
+def prepare(case, count, guild):
+    """Everything the stages start from: the messages, their comic data and its layout."""
+    font = get_asset_cache(DATAPATH).font_chain(FONT)
+    messages = make_messages(case, count, guild)
+    characters = {id: CHARS[index] for index, id in enumerate(sorted(set(m.author_id for m in messages)))}
+    sanitizer = Sanitizer()
+    comic = group_panels([ComicEntry(m.author_id, sanitizer.sanitize(guild, m)) for m in messages], font, TEXT_WIDTH)
+    return SimpleNamespace(
+        guild=guild, font=font, messages=messages, characters=characters, comic=comic,
+        layout=layout_comic(comic, font)
+        )
+
+
+def make_stages(inputs, panel_threads):
+    """{stage name: function that runs it}, in the order they get reported."""
+    guild = inputs.guild
+    font = inputs.font
+    messages = inputs.messages
+    characters = inputs.characters
+    comic = inputs.comic
+    layout = inputs.layout
+    texts = [side["text"] for panel in comic for side in panel if side.get("text")]
+
+    def comicdata():
+        # Fresh sanitizer every time so we time the work, not its cache
+        sanitizer = Sanitizer()
+        entries = [ComicEntry(m.author_id, sanitizer.sanitize(guild, m)) for m in messages]
+        return group_panels(entries, font, TEXT_WIDTH)
+
+    def draw():
+        for _ in render_panels(DATAPATH, layout, characters, BACKGROUND, FONT):
+            pass
+
+    def draw_parallel():
+        for _ in render_panels(DATAPATH, layout, characters, BACKGROUND, FONT, threads=panel_threads):
+            pass
+
+    # Whole-comic assembly, the way the non-streaming encoders need it
+    def assemble_pil():
+        canvas = Image.new("RGBA", (layout.width, layout.height))
+        for panel, image in zip(layout.panels, render_panels(DATAPATH, layout, characters, BACKGROUND, FONT)):
+            canvas.paste(image, (0, panel.top))
+        return canvas
+
+    def render_auto():
+        return encode_comic(assemble_pil(), encodings=ENCODING_MODES["auto"])
+
+    stages = {
+        "comicdata": comicdata,
+        "wrap": lambda: wrap_many(texts, font, TEXT_WIDTH),
+        "layout": lambda: layout_comic(comic, font),
+        "draw": draw,
+        "draw_parallel": draw_parallel,
+        "assemble_pil": assemble_pil,
+    }
+    if HAVE_NUMPY:
+        stages["assemble_numpy"] = lambda: composite_comic(DATAPATH, layout, characters, BACKGROUND, FONT)
+    stages["render_png"] = lambda: stream_png(
+        render_panels(DATAPATH, layout, characters, BACKGROUND, FONT), layout.width, layout.height
+        )
+    stages["render_auto"] = render_auto
+    return stages
+
+
+def _max_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS counts bytes, everything else KiB
+    return peak/1024 if sys.platform == "darwin" else peak
+
+
+def stage_peak_rss(case, count, stage, panel_threads):
+    """
+        Runs one stage in this (fresh) process and returns how many KiB it
+        pushed the peak RSS up by.
+    """
+    inputs = prepare(case, count, make_guild())
+    # Drawing every panel once loads the fonts, background and sprites, so
+    # what gets counted is the stage itself and not the asset cache filling
+    for _ in render_panels(DATAPATH, inputs.layout, inputs.characters, BACKGROUND, FONT):
+        pass
+    function = make_stages(inputs, panel_threads)[stage]
+    # Decoding and scaling raw sprites peaks far higher than any stage, and
+    # the peak never comes back down. A forked process starts out with its
+    # peak at what it has now though, so the stage gets measured in one
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        before = _max_rss_kib()
+        function()
+        os.write(write, str(_max_rss_kib()-before).encode())
+        os._exit(0)
+    os.close(write)
+    os.waitpid(pid, 0)
+    with os.fdopen(read) as result:
+        return float(result.read())
+
+
+def peak_rss(case, count, stage, panel_threads):
+    """stage_peak_rss in a brand new process, or None where there's no getrusage."""
+    if resource is None:
+        return None
+    # A fresh process every time, since the peak only ever goes up
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(stage_peak_rss, case, count, stage, panel_threads).result()
+
+
+def measure(function, repeat):
+    """Runs function repeat times, returning (result, median seconds)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter()-start)
+    return result, median(times)
+
+
+def run_case(case, count, guild, repeat, panel_threads):
+    results = {}
+    outputs = {}
+    for stage, function in make_stages(prepare(case, count, guild), panel_threads).items():
+        outputs[stage], seconds = measure(function, repeat)
+        results[stage] = {"seconds": seconds, "peak_rss_kib": peak_rss(case, count, stage, panel_threads)}
+    if HAVE_NUMPY and outputs["assemble_numpy"].tobytes() != outputs["assemble_pil"].tobytes():
+        raise AssertionError(f"NumPy compositor doesn't match PIL for {case}-{count}")
+    for stage in ("render_png", "render_auto"):
+        results[stage]["bytes"] = outputs[stage].size
+    results["render_auto"]["encoding"] = outputs["render_auto"].encoding
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta=0.001):
+    """Returns ([regressions], [name/stage with nothing in the baseline to compare to])."""
+    regressions = []
+    missing = []
+    for name, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get("results", {}).get(name, {}).get(stage)
+            if not previous:
+                missing.append(f"{name}/{stage}")
+                continue
+            # Sub-millisecond stages jitter by more than any sane tolerance
+            slower = current["seconds"]-previous["seconds"]
+            if current["seconds"] > previous["seconds"]*tolerance and slower > min_delta:
+                regressions.append(f"{name}/{stage}: {previous['seconds']*1000:.1f}ms -> {current['seconds']*1000:.1f}ms")
+            if "bytes" in current and current["bytes"] > previous.get("bytes", current["bytes"]):
+                regressions.append(f"{name}/{stage}: {previous['bytes']} -> {current['bytes']} bytes")
+    return regressions, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="exit non-zero on regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="slowdowns smaller than this never count as regressions")
+    parser.add_argument("--panel-threads", type=int, default=max(2, os.cpu_count() or 1),
+                        help="threads for the draw_parallel stage")
+    args = parser.parse_args()
+
+    guild = make_guild()
+    results = {}
+    for case in args.cases:
+        for count in args.sizes:
+            name = f"{case}-{count}"
+            results[name] = run_case(case, count, guild, args.repeat, args.panel_threads)
+            summary = "  ".join(
+                f"{stage} {data['seconds']*1000:8.1f}ms" for stage, data in results[name].items()
+            )
+            print(f"{name:>14}: {summary}")
+
+    if args.save:
+        with open(args.baseline, "w") as output:
+            json.dump({
+                "python": platform.python_version(),
+                "pillow": PIL.__version__,
+                "machine": platform.machine(),
+                "results": results,
+            }, output, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as baseline_file:
+            regressions, missing = compare(
+                results, json.load(baseline_file), args.tolerance, args.min_delta_ms/1000
+                )
+        # Not a failure, but nothing's checking these until --save is run
+        for stage in missing:
+            print(f"NOT IN BASELINE {stage}")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+    Image-diff tests for weeedcog's glyph atlas: text drawn from the atlas
+    has to come out pixel for pixel the same as Pillow drawing it with
+    FreeType, for every bundled font.
+"""
+
+import sys
+from os import listdir
+from os.path import abspath, dirname, join
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from weeedcog.fonts import FontChain, GlyphAtlas, read_coverage  # noqa: E402
+
+FONT_PATH = join(dirname(dirname(abspath(__file__))), "weeedcog", "data", "font")
+FONTS = sorted(listdir(FONT_PATH))
+SIZE = 15
+# Kerning pairs, overlapping glyphs, punctuation and descenders
+LINES = [
+    "AVATAR Wally's Toy Yard: To LT, fly? 'quoted'",
+    "Te Va Ty, WAVE office ffi fj //// .... ((()))",
+    "Whoa there, shitlord! 0123456789 jgpqy",
+]
+
+
+def _font(name):
+    return ImageFont.truetype(join(FONT_PATH, name), SIZE)
+
+
+def _assert_same(expected, actual):
+    difference = ImageChops.difference(expected.convert("RGB"), actual.convert("RGB"))
+    assert difference.getbbox() is None, f"differs in {difference.getbbox()}"
+
+
+@pytest.mark.parametrize("name", FONTS)
+def test_atlas_line_matches_freetype(name):
+    font = _font(name)
+    atlas = GlyphAtlas(font)
+    for line in LINES:
+        expected = Image.new("RGB", (500, 30), (40, 90, 160))
+        actual = expected.copy()
+        ImageDraw.Draw(expected).text((7, 3), line, font=font, fill="white")
+        atlas.draw(ImageDraw.Draw(actual), (7, 3), line, "white")
+        _assert_same(expected, actual)
+
+
+@pytest.mark.parametrize("name", FONTS)
+def test_chain_matches_multiline_text(name):
+    font = _font(name)
+    chain = FontChain((name,), (font,), (None,))
+    text = "\n".join(LINES)
+    expected = Image.new("RGB", (500, 80), (40, 90, 160))
+    actual = expected.copy()
+    ImageDraw.Draw(expected).multiline_text((4, 2), text, font=font, fill="white")
+    chain.draw(ImageDraw.Draw(actual), (4, 2), text, chain.line_runs(text), "white")
+    _assert_same(expected, actual)
+
+
+@pytest.mark.parametrize("name", FONTS)
+def test_chain_fallback_runs_match_freetype(name):
+    # Every other bundled font as a fallback, so a character the primary
+    # font doesn't have gets drawn in one that does
+    names = [name] + [other for other in FONTS if other != name]
+    fonts = [_font(other) for other in names]
+    chain = FontChain(names, fonts, [read_coverage(join(FONT_PATH, other)) for other in names])
+    text = "ŝtrange ünïcode Ωmega\nπ ≈ 3.14 → ∞ ★"
+    line_runs = chain.line_runs(text)
+    expected = Image.new("RGB", (500, 60), (40, 90, 160))
+    actual = expected.copy()
+    draw = ImageDraw.Draw(expected)
+    for number, line in enumerate(line_runs or ()):
+        baseline = 2+number*chain.line_height+chain.ascent
+        for index, offset, run in line:
+            draw.text((4+int(offset), baseline), run, font=fonts[index], fill="white", anchor="ls")
+    if line_runs is None:
+        draw.multiline_text((4, 2), text, font=chain.primary, fill="white")
+    chain.draw(ImageDraw.Draw(actual), (4, 2), text, line_runs, "white")
+    _assert_same(expected, actual)
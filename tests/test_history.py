@@ -0,0 +1,137 @@
+"""
+    Tests for weeedcog's message buffer: splitting channels into
+    conversations as messages come in, and picking out the conversation
+    leading up to a comic.
+"""
+
+import sys
+from datetime import datetime, timedelta, timezone
+from os.path import abspath, dirname
+from types import SimpleNamespace
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from weeedcog.history import (  # noqa: E402
+    CONVERSATION_WINDOW, CachedMessage, ChannelBuffer, MessageBuffer, take_conversation
+)
+
+CHANNEL = 42
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# Seconds each message was sent at: conversations start at 0, 40 and 200
+TIMES = [0, 5, 10, 40, 45, 50, 55, 200, 205, 210]
+
+
+def _at(seconds):
+    return EPOCH+timedelta(seconds=seconds)
+
+
+def _message(id, seconds, author_id=1):
+    return CachedMessage(id=id, author_id=author_id, content=f"message {id}", created_at=_at(seconds),
+                         edited_at=None)
+
+
+def _messages(times=TIMES):
+    return [_message(index+1, seconds) for index, seconds in enumerate(times)]
+
+
+def _buffer(messages, size=200):
+    """A MessageBuffer that's seen messages come in on CHANNEL."""
+    buffer = MessageBuffer(channel_size=size)
+    for message in messages:
+        buffer.add(SimpleNamespace(
+            id=message.id, author=SimpleNamespace(id=message.author_id), content=message.content,
+            created_at=message.created_at, edited_at=message.edited_at, channel=SimpleNamespace(id=CHANNEL)
+            ))
+    return buffer
+
+
+def _ids(messages):
+    return None if messages is None else [message.id for message in messages]
+
+
+def test_channel_buffer_tracks_conversation_starts():
+    buffer = ChannelBuffer(200)
+    for message in _messages():
+        buffer.append(message)
+    # The first conversation started before we were listening
+    assert list(buffer.starts) == [None]*3 + [4]*4 + [8]*3
+
+
+def test_channel_buffer_refill_keeps_first_start():
+    buffer = ChannelBuffer(200)
+    buffer.refill(_messages()[3:], first_start=4)
+    assert list(buffer.starts) == [4]*4 + [8]*3
+
+
+def test_take_conversation_stops_at_gap():
+    newest_first = list(reversed(_messages()))
+    taken, boundary = take_conversation(newest_first, _at(212)-CONVERSATION_WINDOW, 80)
+    assert (_ids(taken), boundary) == ([8, 9, 10], True)
+
+
+def test_take_conversation_stops_at_window():
+    newest_first = list(reversed(_messages([0, 10, 20, 30, 40, 50])))
+    taken, boundary = take_conversation(newest_first, _at(25), 80)
+    assert (_ids(taken), boundary) == ([4, 5, 6], True)
+
+
+def test_take_conversation_stops_at_limit():
+    newest_first = list(reversed(_messages()))
+    taken, boundary = take_conversation(newest_first, _at(212)-CONVERSATION_WINDOW, 2)
+    assert (_ids(taken), boundary) == ([9, 10], True)
+
+
+def test_take_conversation_counts_gap_before_newer():
+    newest_first = list(reversed(_messages()))
+    taken, boundary = take_conversation(newest_first, _at(0), 80, newer=_at(240))
+    assert (taken, boundary) == ([], True)
+
+
+def test_take_conversation_running_out():
+    newest_first = list(reversed(_messages()[:3]))
+    taken, boundary = take_conversation(newest_first, _at(0), 80)
+    assert (_ids(taken), boundary) == ([1, 2, 3], False)
+
+
+def test_take_conversation_zero_limit():
+    assert take_conversation(iter(_messages()), _at(0), 0) == ([], True)
+
+
+def test_conversation_from_buffer():
+    buffer = _buffer(_messages())
+    since = _at(212)-CONVERSATION_WINDOW
+    assert _ids(buffer.conversation(CHANNEL, 11, since, 80)) == [8, 9, 10]
+    assert _ids(buffer.conversation(CHANNEL, 11, since, 2)) == [9, 10]
+    assert _ids(buffer.conversation(CHANNEL, 11, since, 0)) == []
+
+
+def test_conversation_before_anchor():
+    buffer = _buffer(_messages())
+    assert _ids(buffer.conversation(CHANNEL, 6, _at(46)-CONVERSATION_WINDOW, 80)) == [4, 5]
+
+
+def test_conversation_needs_its_start():
+    # We started listening partway through the first conversation, so the
+    # buffer can't tell how far back it goes
+    buffer = _buffer(_messages())
+    assert buffer.conversation(CHANNEL, 3, _at(10)-CONVERSATION_WINDOW, 80) is None
+    assert buffer.conversation(CHANNEL+1, 3, _at(10)-CONVERSATION_WINDOW, 80) is None
+
+
+def test_conversation_after_delete():
+    buffer = _buffer(_messages())
+    buffer.delete(CHANNEL, {9})
+    assert _ids(buffer.conversation(CHANNEL, 11, _at(212)-CONVERSATION_WINDOW, 80)) == [8, 10]
+
+
+def test_conversation_start_survives_eviction():
+    # The ring only holds the last 5, but message 4 started a conversation
+    # while we were listening, so we still know where it begins
+    buffer = _buffer(_messages()[:7], size=5)
+    assert _ids(buffer.conversation(CHANNEL, 8, _at(56)-CONVERSATION_WINDOW, 80)) == [4, 5, 6, 7]
+
+
+def test_conversation_survives_resize():
+    buffer = _buffer(_messages())
+    buffer.configure(channel_size=4)
+    assert _ids(buffer.conversation(CHANNEL, 11, _at(212)-CONVERSATION_WINDOW, 80)) == [8, 9, 10]
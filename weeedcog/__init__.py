@@ -1,8 +1,7 @@
-from .weeed import WeeedBot
-from redbot.core import data_manager
-from shutil import rmtree
-
-
 async def setup(bot):
+    # WeeedBot is imported here rather than at module level so that render
+    # workers (which import weeedcog.renderer) don't have to drag in redbot
+    # and discord.py just to draw a picture.
+    from .weeed import WeeedBot
     cog = WeeedBot(bot)
     await bot.add_cog(cog)
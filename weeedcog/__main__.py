@@ -0,0 +1,220 @@
+"""
+    Renders comics from message dumps, no bot required.
+
+    Each dump is a JSONL file with one message per line:
+
+        {"author_id": 1234, "display_name": "luna", "content": "hi <@5678>",
+         "timestamp": "2020-04-20T16:20:00+00:00"}
+
+    "id" is optional (the line number is used if it's missing) but has to be
+    unique within a dump, and "timestamp" can be ISO 8601 or a unix time.
+    Every dump gets cut into comics of --count messages, which go through the
+    same sanitizing, panel grouping, layout and rendering the cog uses,
+    spread across every core. Run it from the repo root:
+
+        python -m weeedcog dumps/*.jsonl --out comics/
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from os.path import basename, dirname, join, splitext
+from statistics import median
+from time import perf_counter
+from types import SimpleNamespace
+from .assets import get_asset_cache
+from .backgrounds import BACKGROUND_MODES, pick_backgrounds
+from .characters import cast_characters
+from .encoder import DEFAULT_BUDGET, ENCODING_MODES
+from .history import CachedMessage
+from .layout import layout_comic, messages_to_comicdata
+from .manifest import AssetManifest
+from .renderer import render_comic
+from .sanitizer import sanitize_text
+
+
+DATAPATH = join(dirname(os.path.abspath(__file__)), "data")
+# Dumps don't come from a guild, so everyone's characters are worked out as
+# if they were all in this one
+DUMP_GUILD_ID = 0
+
+
+class DumpGuild(object):
+    """Just enough of a guild for sanitizing: the names of everyone in the dump."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def get_member(self, id):
+        name = self.names.get(id)
+        return SimpleNamespace(id=id, display_name=name) if name else None
+
+    def get_role(self, id):
+        return None
+
+    def get_channel(self, id):
+        return None
+
+
+def _parse_time(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    return datetime.fromisoformat(value)
+
+
+def _parse_line(line, number):
+    """Returns (CachedMessage, display name) for one line of a dump."""
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    author_id = int(data["author_id"])
+    message = CachedMessage(
+        id=int(data.get("id", number)),
+        author_id=author_id,
+        content=data["content"],
+        created_at=_parse_time(data["timestamp"]),
+        edited_at=None
+        )
+    return message, data.get("display_name") or str(author_id)
+
+
+def read_dump(path):
+    """
+        Returns ([CachedMessage], {author ID: display name}) from a JSONL
+        dump. Raises ValueError, naming the line, if a line isn't a valid
+        message or an ID repeats.
+    """
+    messages = []
+    names = {}
+    seen = set()
+    with open(path, encoding="utf-8") as dump:
+        for number, line in enumerate(dump, start=1):
+            if not line.strip():
+                continue
+            try:
+                message, name = _parse_line(line, number)
+            except KeyError as error:
+                raise ValueError(f"{path}:{number}: message has no \"{error.args[0]}\"") from None
+            except (TypeError, ValueError) as error:
+                raise ValueError(f"{path}:{number}: {error}") from None
+            if message.id in seen:
+                raise ValueError(f"{path}:{number}: message ID {message.id} is already used earlier in the dump")
+            seen.add(message.id)
+            names[message.author_id] = name
+            messages.append(message)
+    return messages, names
+
+
+class DumpSanitizer(object):
+    """
+        Sanitizes without the cog's cache: dump message IDs are only unique
+        within one dump, and every message only ends up in one comic anyway.
+    """
+
+    def sanitize(self, guild, message):
+        return sanitize_text(guild, message.content)
+
+
+_sanitizer = DumpSanitizer()
+
+
+def render_job(output_path, messages, names, characters, options):
+    """Renders one comic to output_path (minus extension) in a worker process."""
+    start = perf_counter()
+    font = get_asset_cache(options.datapath).font_chain(options.font)
+    comic = messages_to_comicdata(DumpGuild(names), messages, font, _sanitizer)
+    layout = layout_comic(comic, font)
+    backgrounds = pick_backgrounds(
+        options.background_mode, options.background, options.background_choices,
+        len(layout.panels), seed=messages[-1].id
+        )
+    encoded, _ = render_comic(
+        options.datapath, layout, characters, backgrounds, options.font,
+        sprite_path=options.sprite_cache, budget=options.budget, encodings=ENCODING_MODES[options.encoding]
+        )
+    with open(f"{output_path}.{encoded.extension}", "wb") as output:
+        output.write(encoded.data)
+    if options.info:
+        with open(f"{output_path}.json", "w") as output:
+            json.dump({
+                "comic": comic,
+                "characters": {str(id): char for id, char in characters.items()},
+                "backgrounds": backgrounds,
+                "encoding": encoded.encoding
+            }, output)
+    return encoded.encoding, encoded.size, encoded.fits, perf_counter()-start
+
+
+def plan_jobs(paths, count, out, available):
+    """Cuts every dump into comics and casts each one, like the cog would."""
+    assigned = {}
+    jobs = []
+    for path in paths:
+        messages, names = read_dump(path)
+        stem = splitext(basename(path))[0]
+        for number, first in enumerate(range(0, len(messages), count)):
+            chunk = messages[first:first+count]
+            author_ids = list(dict.fromkeys(m.author_id for m in chunk))
+            characters, new = cast_characters(DUMP_GUILD_ID, author_ids, assigned, available)
+            assigned.update(new)
+            jobs.append((join(out, f"{stem}-{number:05d}"), chunk, names, characters))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m weeedcog", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("dumps", nargs="+", help="JSONL message dumps")
+    parser.add_argument("--out", default="comics", help="directory to write comics to")
+    parser.add_argument("--count", type=int, default=10, help="messages per comic")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="render processes")
+    parser.add_argument("--datapath", default=DATAPATH, help="bundled data folder")
+    parser.add_argument("--font", default="ComicBD.ttf")
+    parser.add_argument("--background", default="beach-paradise-beach-desktop.jpg")
+    parser.add_argument("--background-mode", default="fixed", choices=BACKGROUND_MODES)
+    parser.add_argument("--encoding", default="png", choices=list(ENCODING_MODES))
+    parser.add_argument("--budget", type=int, default=DEFAULT_BUDGET, help="max bytes per comic")
+    parser.add_argument("--sprite-cache", default=None, help="directory to keep scaled sprites in")
+    parser.add_argument("--info", action="store_true", help="write each comic's data next to it")
+    options = parser.parse_args(argv)
+    if options.count < 1:
+        parser.error("--count has to be at least 1")
+
+    manifest = AssetManifest(options.datapath)
+    for kind, name in (("font", options.font), ("background", options.background)):
+        if not manifest.has(kind, name):
+            parser.error(f"Couldn't find a {kind} file called '{name}'")
+    options.background_choices = list(manifest.names("background")) if options.background_mode != "fixed" else []
+    os.makedirs(options.out, exist_ok=True)
+    try:
+        jobs = plan_jobs(options.dumps, options.count, options.out, manifest.names("char"))
+    except ValueError as error:
+        parser.error(str(error))
+
+    start = perf_counter()
+    times = []
+    too_big = 0
+    with ProcessPoolExecutor(max_workers=options.workers) as executor:
+        futures = {
+            executor.submit(render_job, path, messages, names, characters, options): path
+            for path, messages, names, characters in jobs
+        }
+        for future in as_completed(futures):
+            encoding, size, fits, seconds = future.result()
+            times.append(seconds)
+            if not fits:
+                too_big += 1
+                print(f"{futures[future]}: {size} bytes as {encoding}, over budget", file=sys.stderr)
+    elapsed = perf_counter()-start
+    if times:
+        print(
+            f"{len(times)} comics in {elapsed:.1f}s ({len(times)/elapsed:.2f}/s) on {options.workers} workers, "
+            f"median {median(times)*1000:.0f}ms per comic, {too_big} over budget"
+            )
+    return 1 if too_big else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+from os import listdir
+from os.path import getsize
+from threading import RLock
+from collections import OrderedDict
+from PIL import Image, ImageFont
+from .fonts import FontChain, read_coverage
+from .textwrapper import forget_metrics
+from .layout import PANEL_HEIGHT, PANEL_WIDTH
+from .backgrounds import make_tile
+
+
+# Fonts in the comic are only ever used at this size
+FONT_SIZE = 15
+# Roughly how many bytes of decoded assets we're willing to hold onto per
+# process. Character sprites are the big ones, so this mostly decides how
+# many of them stay decoded between comics.
+DEFAULT_MAX_BYTES = 192 * 1024 * 1024
+
+# One cache per data path per process. Threads share it; render worker
+# processes each end up with their own.
+_caches = {}
+_caches_lock = RLock()
+
+
+# Cache entries built out of each kind of asset, which have to go when it does
+_DERIVED = {
+    "char": ("trimmed", "sprite", "blend"),
+    "font": ("coverage",),
+}
+
+
+def get_asset_cache(datapath):
+    """Returns this process's AssetCache for the given bundled data path."""
+    with _caches_lock:
+        if datapath not in _caches:
+            _caches[datapath] = AssetCache(datapath)
+        return _caches[datapath]
+
+
+def warm_asset_cache(datapath, backgrounds=()):
+    """Executor initializer that preloads assets in each render worker."""
+    # If this raises the pool is broken for good and every render fails,
+    # while a cold cache just means the first comics load their own assets
+    try:
+        get_asset_cache(datapath).warm(backgrounds=backgrounds)
+    except Exception as error:
+        print(f"[WEEEDCOG] Couldn't warm the asset cache: {error!r}")
+
+
+def _image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class AssetCache(object):
+    """
+        Size-bounded LRU cache of decoded fonts, backgrounds and character
+        sprites, keyed by (asset type, filename, size).
+
+        Once something's been loaded it's served straight from memory, so
+        repeated comics don't touch the disk or decode anything again.
+    """
+
+    def __init__(self, datapath, max_bytes=DEFAULT_MAX_BYTES):
+        self.datapath = datapath
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        # (asset type, filename) -> last invalidation generation we applied
+        self._seen_invalidations = {}
+
+    def get(self, key, loader):
+        """Returns the cached value for key, calling loader() -> (value, nbytes) on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        value, nbytes = loader()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, nbytes)
+                self.current_bytes += nbytes
+                self._evict()
+            return self._entries[key][0]
+
+    def _evict(self):
+        # Never evict the entry we just added, even if it's huge by itself
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+
+    def font(self, name, size=FONT_SIZE):
+        def loader():
+            path = f"{self.datapath}/font/{name}"
+            return ImageFont.truetype(path, size=size), getsize(path)
+        return self.get(("font", name, size), loader)
+
+    def coverage(self, name):
+        def loader():
+            coverage = read_coverage(f"{self.datapath}/font/{name}")
+            return coverage, coverage.nbytes
+        return self.get(("coverage", name, None), loader)
+
+    def font_chain(self, name, size=FONT_SIZE):
+        """The font plus every other bundled font as fallbacks, widest coverage first."""
+        def loader():
+            fallbacks = sorted(
+                (f for f in listdir(f"{self.datapath}/font") if f != name),
+                key=lambda f: (-self.coverage(f).count, f)
+                )
+            names = [name]+fallbacks
+            chain = FontChain(names, [self.font(n, size) for n in names], [self.coverage(n) for n in names])
+            # The fonts and bitmaps are accounted for under their own keys
+            return chain, 0
+        return self.get(("chain", name, size), loader)
+
+    def background(self, name, size=(PANEL_WIDTH, PANEL_HEIGHT)):
+        """A background as a ready-to-paste RGBA tile, cut to size."""
+        def loader():
+            with Image.open(f"{self.datapath}/background/{name}") as image:
+                tile = make_tile(image, size)
+            return tile, _image_bytes(tile)
+        return self.get(("background", name, size), loader)
+
+    def char(self, name):
+        def loader():
+            image = Image.open(f"{self.datapath}/char/{name}")
+            image.load()
+            return image, _image_bytes(image)
+        return self.get(("char", name, None), loader)
+
+    def invalidate(self, kind, name):
+        """Drops every cached size of one asset, and everything made from it."""
+        kinds = (kind,)+_DERIVED.get(kind, ())
+        with self._lock:
+            # Any font might be in any chain, so those all go too
+            for key in [
+                k for k in self._entries
+                if (k[0] in kinds and k[1] == name) or (kind == "font" and k[0] == "chain")
+            ]:
+                _, nbytes = self._entries.pop(key)
+                self.current_bytes -= nbytes
+        # The wrapper's measurements are bound to the old font objects
+        if kind == "font":
+            forget_metrics(f"{self.datapath}/font/{name}")
+
+    def apply_invalidations(self, invalidations):
+        """
+            Applies a {(asset type, filename): generation} map handed over by
+            the renderer. Each invalidation only gets applied once per process.
+        """
+        if not invalidations:
+            return
+        with self._lock:
+            for (kind, name), generation in invalidations.items():
+                if self._seen_invalidations.get((kind, name), 0) < generation:
+                    self._seen_invalidations[(kind, name)] = generation
+                    self.invalidate(kind, name)
+
+    def warm(self, backgrounds=()):
+        """
+            Preloads the given backgrounds' tiles (or every background's, if
+            None) and every font's fallback chain. Raw character sprites are
+            left alone: they're only ever the input to a scaled sprite, which
+            usually comes off the sprite cache on disk anyway, and decoding
+            all of them up front costs hundreds of megabytes per process.
+            Anything that's missing or won't load gets skipped, since warming
+            is only ever a head start.
+        """
+        if backgrounds is None:
+            backgrounds = listdir(f"{self.datapath}/background")
+        for background in backgrounds:
+            self._warm("background", background, self.background)
+        for font in listdir(f"{self.datapath}/font"):
+            self._warm("font", font, self.font_chain)
+
+    def _warm(self, kind, name, loader):
+        try:
+            loader(name)
+        except Exception as error:
+            print(f"[WEEEDCOG] Not warming {kind} {name}: {error!r}")
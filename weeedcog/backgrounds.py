@@ -0,0 +1,37 @@
+from random import Random
+from PIL import Image
+
+
+# fixed: the guild's background_image on every panel
+# random_comic: one random background for the whole comic
+# random_panel: a random background for every panel
+BACKGROUND_MODES = ("fixed", "random_comic", "random_panel")
+
+
+def make_tile(image, size):
+    """
+        Cuts a panel-sized RGBA tile out of a background. Panels have always
+        shown the top left corner of the background, so that's what we keep;
+        backgrounds too small to cover a panel get scaled up until they do.
+    """
+    (width, height) = size
+    if image.width < width or image.height < height:
+        scale = max(width/image.width, height/image.height)
+        image = image.resize((round(image.width*scale), round(image.height*scale)), Image.LANCZOS)
+    # Cropping first means only the tile gets converted
+    return image.crop((0, 0, width, height)).convert("RGBA")
+
+
+def pick_backgrounds(mode, background, available, panels, seed):
+    """
+        One background filename per panel. Random picks are seeded (with the
+        comic's last message ID) so the same comic always gets the same
+        backgrounds, which keeps the comic cache and coalescing working.
+    """
+    if mode == "fixed" or not available:
+        return [background]*panels
+    rng = Random(seed)
+    available = sorted(available)
+    if mode == "random_comic":
+        return [rng.choice(available)]*panels
+    return [rng.choice(available) for _ in range(panels)]
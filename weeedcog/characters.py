@@ -0,0 +1,52 @@
+from hashlib import sha256
+
+
+def _start(guild_id, user_id, count):
+    # Not hash(), since that changes from run to run for strings
+    digest = sha256(f"{guild_id}:{user_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def assign_character(guild_id, user_id, available, taken=()):
+    """
+        Picks a character for someone who doesn't have one yet. Everyone
+        gets a fixed starting point in the (sorted) list of characters based
+        on who they are, and we walk forward from there to the first one
+        nobody in the guild has. Once everyone has one, people share.
+    """
+    start = _start(guild_id, user_id, len(available))
+    for offset in range(len(available)):
+        candidate = available[(start+offset) % len(available)]
+        if candidate not in taken:
+            return candidate
+    return available[start]
+
+
+def cast_characters(guild_id, author_ids, assigned, available):
+    """
+        Works out who's drawn as what in one comic.
+
+        assigned is the guild's saved {str(user ID): character}; available
+        is the sorted tuple of character filenames. Returns ({author ID:
+        character}, {str(user ID): character} of new assignments to save).
+
+        Authors without a character (or whose character has since been
+        removed) get one assigned. If two authors in the same comic ended up
+        with the same character, whoever spoke later gets a stand-in for this
+        comic only, as long as there are characters to spare.
+    """
+    new = {}
+    taken = set(assigned.values())
+    characters = {}
+    used = set()
+    for author_id in author_ids:
+        char = assigned.get(str(author_id))
+        if char not in available:
+            char = assign_character(guild_id, author_id, available, taken)
+            new[str(author_id)] = char
+            taken.add(char)
+        if char in used and len(used) < len(available):
+            char = assign_character(guild_id, author_id, available, used)
+        characters[author_id] = char
+        used.add(char)
+    return characters, new
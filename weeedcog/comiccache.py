@@ -0,0 +1,134 @@
+import json
+from hashlib import sha256
+from os import listdir, makedirs, remove, replace, utime
+from os.path import getmtime, getsize, join
+from threading import RLock
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def comic_key(messages, characters, font, background, encodings, budget, render_version, asset_stamps=None):
+    """
+        Hash of everything that decides what a comic looks like: which
+        messages (and which edit of each) are in it, who's drawn as what,
+        the assets (and, with asset_stamps, which version of each file), how
+        it gets encoded, and the renderer version.
+    """
+    material = {
+        "messages": [
+            [m.id, m.edited_at.isoformat() if m.edited_at else None]
+            for m in messages
+        ],
+        "characters": sorted([str(id), char] for id, char in characters.items()),
+        "font": font,
+        "background": background,
+        "encodings": list(encodings),
+        "budget": budget,
+        "render_version": render_version,
+        "asset_stamps": asset_stamps,
+    }
+    return sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+
+class CachedComic(NamedTuple):
+    key: str
+    data: bytes
+    extension: str
+    # The comic data and render details stored alongside the image
+    info: dict
+
+
+class ComicCache(object):
+    """
+        Disk-backed cache of rendered comics. Each comic is stored as
+        <key>.<extension> with the comic data that produced it next to it
+        in <key>.json, which also makes weird comics easy to debug.
+
+        Entries are evicted least recently used first once the files add up
+        to more than max_bytes. File mtimes double as the LRU order, so it
+        survives restarts.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        # key -> (image extension, bytes on disk), least recently used first
+        self._index = OrderedDict()
+        self._lock = RLock()
+        makedirs(path, exist_ok=True)
+        self._load_index()
+
+    def _files(self, key, extension):
+        return join(self.path, f"{key}.{extension}"), join(self.path, f"{key}.json")
+
+    def _load_index(self):
+        entries = []
+        for filename in listdir(self.path):
+            key, _, extension = filename.partition(".")
+            if extension in ("json", "") or extension.endswith(".tmp"):
+                continue
+            image_path, info_path = self._files(key, extension)
+            try:
+                nbytes = getsize(image_path)+getsize(info_path)
+            except OSError:
+                continue
+            entries.append((getmtime(image_path), key, extension, nbytes))
+        for _, key, extension, nbytes in sorted(entries):
+            self._index[key] = (extension, nbytes)
+            self.current_bytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._index:
+            key, (extension, nbytes) = self._index.popitem(last=False)
+            self.current_bytes -= nbytes
+            for path in self._files(key, extension):
+                try:
+                    remove(path)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+            extension, _ = self._index[key]
+        image_path, info_path = self._files(key, extension)
+        try:
+            with open(image_path, "rb") as image_file:
+                data = image_file.read()
+            with open(info_path) as info_file:
+                info = json.load(info_file)
+            utime(image_path)
+        except (OSError, ValueError):
+            # Somebody cleaned up the folder under us; treat it as a miss
+            with self._lock:
+                if key in self._index:
+                    self.current_bytes -= self._index.pop(key)[1]
+            return None
+        return CachedComic(key=key, data=data, extension=extension, info=info)
+
+    def put(self, key, data, extension, info):
+        image_path, info_path = self._files(key, extension)
+        info_bytes = json.dumps(info).encode()
+        for path, contents in ((info_path, info_bytes), (image_path, data)):
+            with open(f"{path}.tmp", "wb") as output:
+                output.write(contents)
+            replace(f"{path}.tmp", path)
+        with self._lock:
+            if key in self._index:
+                self.current_bytes -= self._index.pop(key)[1]
+            self._index[key] = (extension, len(data)+len(info_bytes))
+            self.current_bytes += len(data)+len(info_bytes)
+            self._evict()
+
+    def resize(self, max_bytes):
+        """Changes the size limit, evicting right away if we're now over it."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
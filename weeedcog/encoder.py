@@ -0,0 +1,236 @@
+"""
+    Output encoding for rendered comics.
+
+    A comic can be written out in a handful of ways, and the right one depends
+    on how long it is and how big an upload the guild allows. encode_comic
+    picks the allowed format that comes out smallest while fitting the budget.
+"""
+
+from io import BytesIO
+from struct import pack
+from time import perf_counter
+from typing import Dict, NamedTuple
+from zlib import compressobj, crc32
+from PIL import Image, ImageChops
+
+
+# WebP can't store anything taller than this, which is ~54 panels
+WEBP_MAX_DIMENSION = 16383
+# Comics taller than this never get put together as one canvas (that's
+# ~29MB of RGBA already), they get streamed out a panel at a time instead
+STREAM_HEIGHT = WEBP_MAX_DIMENSION
+# Discord's upload limit for guilds without any boosts
+DEFAULT_BUDGET = 8 * 1024 * 1024
+# How much of the top of a long comic gets encoded to pick a format (4 panels)
+SAMPLE_HEIGHT = 1200
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+NO_FILTER = b"\x00"
+UP_FILTER = b"\x02"
+
+# Every format we know how to write
+ENCODINGS = ("png", "palette", "webp_lossless", "webp", "jpeg")
+# The ones we can write a strip at a time, smallest first
+STREAMED_ENCODINGS = ("palette", "png")
+# The per-guild "encoding" setting picks one of these sets of formats
+ENCODING_MODES = {
+    # Plain RGBA PNG, which is all this cog ever used to do
+    "png": ("png",),
+    # Nothing that touches the pixels
+    "lossless": ("png", "webp_lossless"),
+    # Whatever's smallest
+    "auto": ENCODINGS,
+}
+
+EXTENSIONS = {
+    "png": "png",
+    "palette": "png",
+    "webp_lossless": "webp",
+    "webp": "webp",
+    "jpeg": "jpg",
+}
+
+
+class EncodedComic(NamedTuple):
+    data: bytes
+    encoding: str
+    extension: str
+    # Whether data is under the budget we were given
+    fits: bool
+    # Seconds spent encoding, across every format we tried
+    elapsed: float
+    # encoding -> (size in bytes, seconds) for every format we tried
+    attempts: Dict[str, tuple]
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+def _encode(image, encoding):
+    output = BytesIO()
+    if encoding == "png":
+        image.save(output, format="PNG")
+    elif encoding == "palette":
+        # FASTOCTREE is the only quantizer that keeps the alpha channel
+        image.quantize(colors=256, method=Image.FASTOCTREE).save(output, format="PNG", optimize=True)
+    elif encoding == "webp_lossless":
+        image.save(output, format="WEBP", lossless=True, method=4)
+    elif encoding == "webp":
+        image.save(output, format="WEBP", quality=85, method=4)
+    elif encoding == "jpeg":
+        # Panels are opaque anyway, so dropping alpha costs nothing
+        image.convert("RGB").save(output, format="JPEG", quality=85, optimize=True)
+    else:
+        raise ValueError(f"Unknown encoding '{encoding}'")
+    return output.getvalue()
+
+
+def encode_comic(image, budget=DEFAULT_BUDGET, encodings=ENCODINGS, sample_height=SAMPLE_HEIGHT):
+    """
+        Encodes image in whichever of the given formats comes out smallest,
+        as long as it's under budget bytes.
+
+        Encoding a comic in every format would take longer than drawing it,
+        so we rank the formats by encoding a sample strip off the top of the
+        image first (at most sample_height rows, and never more than half
+        the image), then encode the whole thing in the best looking format,
+        falling back down the ranking if it doesn't fit. Only the smallest
+        result so far is kept around. If nothing fits, the smallest result
+        is returned anyway with fits=False so the caller can decide what to
+        do.
+    """
+    attempts = {}
+    start = perf_counter()
+    encodings = [
+        encoding for encoding in encodings
+        if not (encoding.startswith("webp") and max(image.size) > WEBP_MAX_DIMENSION)
+    ] or ["png"]
+    if len(encodings) > 1:
+        sample = image.crop((0, 0, image.width, max(1, min(sample_height, image.height // 2))))
+        sample_sizes = {encoding: len(_encode(sample, encoding)) for encoding in encodings}
+        del sample
+        encodings.sort(key=lambda encoding: sample_sizes[encoding])
+    best = None
+    best_data = None
+    for encoding in encodings:
+        encode_start = perf_counter()
+        data = _encode(image, encoding)
+        attempts[encoding] = (len(data), perf_counter()-encode_start)
+        if best_data is None or len(data) < len(best_data):
+            best, best_data = encoding, data
+        del data
+        if len(best_data) <= budget:
+            break
+    return EncodedComic(
+        data=best_data,
+        encoding=best,
+        extension=EXTENSIONS[best],
+        fits=len(best_data) <= budget,
+        elapsed=perf_counter()-start,
+        attempts=attempts
+        )
+
+
+def _png_chunk(kind, data):
+    return pack(">I", len(data)) + kind + data + pack(">I", crc32(kind + data) & 0xffffffff)
+
+
+def make_palette(image, colors=256):
+    """A "P" image whose palette fits image, for StreamingPNGWriter to map strips onto."""
+    return image.convert("RGB").quantize(colors=colors, method=Image.FASTOCTREE)
+
+
+class StreamingPNGWriter(object):
+    """
+        Writes an RGBA PNG a strip at a time, so the whole image never has
+        to exist in memory at once; only the compressed output grows.
+
+        Every row uses PNG's "Up" filter (each byte minus the byte above it),
+        which ImageChops.subtract_modulo does for a whole strip in one go. On
+        comics that compresses a little better than PIL's own PNG encoder.
+
+        Given a palette (see make_palette) it writes a palette PNG instead,
+        mapping every strip onto that palette. The palette has to be picked
+        before the first strip, so it should come from a sample of the whole
+        image. Palette rows are left unfiltered, like PIL does.
+    """
+
+    def __init__(self, width, height, compress_level=6, palette=None):
+        self.width = width
+        self.height = height
+        self.palette = palette
+        self.rows_written = 0
+        self._stride = width if palette is not None else width*4
+        self._compressor = compressobj(compress_level)
+        # The row above the first one is all zeroes as far as PNG cares
+        self._prev_row = Image.new("RGBA", (width, 1))
+        color_type = 3 if palette is not None else 6
+        self._chunks = [
+            PNG_SIGNATURE,
+            _png_chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+            ]
+        if palette is not None:
+            self._chunks.append(_png_chunk(b"PLTE", bytes(palette.getpalette())))
+
+    def _idat(self, data):
+        if data:
+            self._chunks.append(_png_chunk(b"IDAT", data))
+
+    def write(self, strip):
+        """Appends the rows of an RGBA image as wide as the PNG."""
+        if self.palette is not None:
+            self._write_indexes(strip)
+            return
+        above = Image.new("RGBA", strip.size)
+        above.paste(self._prev_row, (0, 0))
+        above.paste(strip.crop((0, 0, strip.width, strip.height-1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+        stride = self._stride
+        rows = b"".join(
+            UP_FILTER + filtered[offset:offset+stride]
+            for offset in range(0, len(filtered), stride)
+            )
+        self._idat(self._compressor.compress(rows))
+        self._prev_row = strip.crop((0, strip.height-1, strip.width, strip.height))
+        self.rows_written += strip.height
+
+    def _write_indexes(self, strip):
+        indexes = strip.convert("RGB").quantize(palette=self.palette, dither=Image.Dither.NONE).tobytes()
+        stride = self._stride
+        rows = b"".join(
+            NO_FILTER + indexes[offset:offset+stride]
+            for offset in range(0, len(indexes), stride)
+            )
+        self._idat(self._compressor.compress(rows))
+        self.rows_written += strip.height
+
+    def finish(self):
+        """Returns the finished PNG bytes."""
+        if self.rows_written != self.height:
+            raise ValueError(f"Wrote {self.rows_written} rows to a PNG {self.height} rows tall")
+        self._idat(self._compressor.flush())
+        self._chunks.append(_png_chunk(b"IEND", b""))
+        return b"".join(self._chunks)
+
+
+def stream_png(strips, width, height, budget=DEFAULT_BUDGET, palette=None):
+    """
+        Encodes an iterable of RGBA strips as one PNG, returning an
+        EncodedComic. With a palette it's a palette PNG.
+    """
+    start = perf_counter()
+    encoding = "palette" if palette is not None else "png"
+    writer = StreamingPNGWriter(width, height, palette=palette)
+    for strip in strips:
+        writer.write(strip)
+    data = writer.finish()
+    elapsed = perf_counter()-start
+    return EncodedComic(
+        data=data,
+        encoding=encoding,
+        extension=EXTENSIONS[encoding],
+        fits=len(data) <= budget,
+        elapsed=elapsed,
+        attempts={encoding: (len(data), elapsed)}
+        )
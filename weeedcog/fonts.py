@@ -0,0 +1,310 @@
+"""
+    Glyph coverage and fallback font chains.
+
+    None of the fonts in data/font cover everything people type, so each
+    font gets a chain of fallbacks: the font itself, then every other bundled
+    font, widest coverage first. Which fonts have a glyph for which
+    codepoints comes straight from their cmap tables, as a bitmap, so picking
+    the font for a character is a lookup instead of a trial render.
+
+    Text gets split into runs of characters that use the same font. The
+    wrapper measures words run by run, and the layout hands the renderer each
+    line's runs already positioned, so the renderer just draws them.
+
+    Drawing goes through a GlyphAtlas per font: every glyph is rasterized by
+    FreeType once, the first time it shows up, and after that drawing text
+    is just blitting masks.
+"""
+
+import struct
+from threading import RLock
+from collections import OrderedDict
+from PIL import Image, ImageChops, ImageDraw
+from .textwrapper import get_metrics
+
+
+# Enough bits for every Unicode codepoint
+CODEPOINTS = 0x110000
+# How many strings' runs each chain remembers
+RUN_CACHE_SIZE = 8192
+# ImageDraw's default gap between lines of multiline text
+LINE_SPACING = 4
+# Whitespace never starts a new run, it just goes with whatever's around it
+_JOINERS = frozenset(" \t\n")
+
+
+class Coverage(object):
+    """Which codepoints a font has glyphs for, one bit per codepoint."""
+
+    def __init__(self, bitmap):
+        self.bitmap = bitmap
+        self.count = bin(int.from_bytes(bitmap, "little")).count("1")
+
+    def __contains__(self, codepoint):
+        return bool(self.bitmap[codepoint >> 3] & (1 << (codepoint & 7)))
+
+    @property
+    def nbytes(self):
+        return len(self.bitmap)
+
+
+def _cmap_format4(data, offset, bitmap):
+    (seg_count_x2,) = struct.unpack_from(">H", data, offset+6)
+    seg_count = seg_count_x2 // 2
+    ends = struct.unpack_from(f">{seg_count}H", data, offset+14)
+    starts = struct.unpack_from(f">{seg_count}H", data, offset+16+seg_count_x2)
+    deltas = struct.unpack_from(f">{seg_count}h", data, offset+16+seg_count_x2*2)
+    range_offsets_at = offset+16+seg_count_x2*3
+    range_offsets = struct.unpack_from(f">{seg_count}H", data, range_offsets_at)
+    for segment, (start, end) in enumerate(zip(starts, ends)):
+        for codepoint in range(start, min(end, 0xFFFE)+1):
+            if range_offsets[segment] == 0:
+                glyph = (codepoint+deltas[segment]) & 0xFFFF
+            else:
+                # idRangeOffset is relative to where it's stored, because
+                # of course it is
+                at = range_offsets_at+segment*2+range_offsets[segment]+(codepoint-start)*2
+                (glyph,) = struct.unpack_from(">H", data, at)
+                if glyph:
+                    glyph = (glyph+deltas[segment]) & 0xFFFF
+            if glyph:
+                bitmap[codepoint >> 3] |= 1 << (codepoint & 7)
+
+
+def _cmap_format12(data, offset, bitmap):
+    (groups,) = struct.unpack_from(">I", data, offset+12)
+    for group in range(groups):
+        (start, end, glyph) = struct.unpack_from(">III", data, offset+16+group*12)
+        # Glyph 0 is .notdef, so a group starting there doesn't cover its
+        # first codepoint
+        for codepoint in range(start+(glyph == 0), min(end, CODEPOINTS-1)+1):
+            bitmap[codepoint >> 3] |= 1 << (codepoint & 7)
+
+
+def read_coverage(path):
+    """Builds a Coverage from a TrueType/OpenType font's Unicode cmap."""
+    with open(path, "rb") as font_file:
+        data = font_file.read()
+    bitmap = bytearray(CODEPOINTS >> 3)
+    (num_tables,) = struct.unpack_from(">H", data, 4)
+    cmap = None
+    for table in range(num_tables):
+        (tag, _, offset, _) = struct.unpack_from(">4sIII", data, 12+table*16)
+        if tag == b"cmap":
+            cmap = offset
+    if cmap is None:
+        return Coverage(bitmap)
+    # Prefer the full-range format 12 table over the BMP-only format 4 one
+    (num_subtables,) = struct.unpack_from(">H", data, cmap+2)
+    best = None
+    for subtable in range(num_subtables):
+        (platform, encoding, offset) = struct.unpack_from(">HHI", data, cmap+4+subtable*8)
+        if platform == 0 or (platform == 3 and encoding in (1, 10)):
+            (table_format,) = struct.unpack_from(">H", data, cmap+offset)
+            if table_format == 12 or (table_format == 4 and best is None):
+                best = (table_format, cmap+offset)
+    if best:
+        (table_format, offset) = best
+        if table_format == 12:
+            _cmap_format12(data, offset, bitmap)
+        else:
+            _cmap_format4(data, offset, bitmap)
+    return Coverage(bitmap)
+
+
+def _fixed(length):
+    """A getlength() result back in the 26.6 fixed point FreeType measured it in."""
+    return int(round(length*64))
+
+
+class GlyphAtlas(object):
+    """
+        Rasterized glyph masks for one font, with their offsets and advances,
+        filled in lazily. Drawing text blits each glyph's mask where FreeType
+        would have put it, so it comes out the same as draw.text.
+
+        The pen is kept in FreeType's 26.6 fixed point and rounded the way
+        Pillow rounds it, since kerning adjustments can be a fraction of a
+        pixel and truncating them shifts glyphs over by one.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.ascent = font.getmetrics()[0]
+        # Only bother with pair adjustments for fonts that have any
+        self.kerning = get_metrics(font).kerning
+        # character -> (mask, x offset, y offset, advance in 26.6)
+        self._glyphs = {}
+        self._pairs = {}
+
+    def glyph(self, char):
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            (left, top, right, bottom) = self.font.getbbox(char)
+            mask = Image.new("L", (max(right-left, 0), max(bottom-top, 0)))
+            if mask.width and mask.height:
+                ImageDraw.Draw(mask).text((-left, -top), char, font=self.font, fill=255)
+            glyph = self._glyphs[char] = (mask, left, top, _fixed(self.font.getlength(char)))
+        return glyph
+
+    def _kern(self, first, second):
+        pair = first+second
+        adjustment = self._pairs.get(pair)
+        if adjustment is None:
+            adjustment = self._pairs[pair] = \
+                _fixed(self.font.getlength(pair))-self.glyph(first)[3]-self.glyph(second)[3]
+        return adjustment
+
+    def draw(self, draw, xy, text, fill):
+        """Draws one line of text with its top (the font's ascender) at xy, like draw.text."""
+        (x, y) = xy
+        placed = []
+        pen = 0
+        previous = None
+        for char in text:
+            (mask, left, top, advance) = self.glyph(char)
+            if self.kerning and previous:
+                pen += self._kern(previous, char)
+            if mask.width and mask.height:
+                placed.append((((pen+32) >> 6)+left, top, mask))
+            pen += advance
+            previous = char
+        if not placed:
+            return
+        # Like FreeType, put the whole line's glyphs into one mask first,
+        # keeping the brighter pixel where they overlap, then draw that once
+        left = min(gx for gx, _, _ in placed)
+        top = min(gy for _, gy, _ in placed)
+        line = Image.new("L", (
+            max(gx+mask.width for gx, _, mask in placed)-left,
+            max(gy+mask.height for _, gy, mask in placed)-top
+            ))
+        right = None
+        for gx, gy, mask in placed:
+            box = (gx-left, gy-top, gx-left+mask.width, gy-top+mask.height)
+            if right is not None and box[0] < right:
+                line.paste(ImageChops.lighter(line.crop(box), mask), box)
+            else:
+                line.paste(mask, box)
+            right = box[2] if right is None else max(right, box[2])
+        draw.bitmap((x+left, y+top), line, fill=fill)
+
+
+class FontChain(object):
+    """
+        A font plus its fallbacks, all at the same size. fonts[0] is the
+        primary font; a character uses the first font in the chain that has
+        a glyph for it, or the primary font if none of them do.
+    """
+
+    def __init__(self, names, fonts, coverages, cache_size=RUN_CACHE_SIZE):
+        self.names = tuple(names)
+        self.fonts = list(fonts)
+        self.coverages = list(coverages)
+        self.primary = self.fonts[0]
+        self.key = ("chain", self.names, self.primary.size)
+        self.cache_size = cache_size
+        # character -> font index, filled in as we see characters
+        self._choices = {}
+        self._runs = OrderedDict()
+        self._lock = RLock()
+        # Same as ImageDraw's multiline spacing for the primary font
+        self.line_height = self.primary.getbbox("A")[3]+LINE_SPACING
+        self.ascent = self.primary.getmetrics()[0]
+        self.atlases = [GlyphAtlas(font) for font in self.fonts]
+
+    def font_for(self, char):
+        index = self._choices.get(char)
+        if index is None:
+            codepoint = ord(char)
+            index = next(
+                (i for i, coverage in enumerate(self.coverages) if coverage is None or codepoint in coverage),
+                0
+                )
+            self._choices[char] = index
+        return index
+
+    def _segment(self, text):
+        runs = []
+        index = 0
+        start = 0
+        for position, char in enumerate(text):
+            if char in _JOINERS:
+                continue
+            char_index = self.font_for(char)
+            if char_index != index and position > start:
+                runs.append((index, text[start:position]))
+                start = position
+            index = char_index
+        if start < len(text) or not runs:
+            runs.append((index, text[start:]))
+        return tuple(runs)
+
+    def runs(self, text):
+        """((font index, text), ...) for a string, segmented once and cached."""
+        with self._lock:
+            runs = self._runs.get(text)
+            if runs is not None:
+                self._runs.move_to_end(text)
+                return runs
+        runs = self._segment(text)
+        with self._lock:
+            self._runs[text] = runs
+            if len(self._runs) > self.cache_size:
+                self._runs.popitem(last=False)
+        return runs
+
+    def primary_only(self, text):
+        runs = self.runs(text)
+        return len(runs) == 1 and runs[0][0] == 0
+
+    def line_runs(self, text):
+        """
+            The runs of every line of multiline text, as ((font index, x
+            offset, text), ...) per line. None if it's all the primary font,
+            in which case plain multiline_text does the job.
+        """
+        if self.primary_only(text):
+            return None
+        lines = []
+        for line in text.split('\n'):
+            x = 0
+            placed = []
+            for index, run in self.runs(line):
+                placed.append((index, x, run))
+                x += self.fonts[index].getlength(run)
+            lines.append(tuple(placed))
+        return tuple(lines)
+
+    def multiline_size(self, text):
+        """
+            (width, height) of a block of wrapped text as draw lays it out.
+            The width comes from the same cached word widths the wrapper
+            used, so sizing a block never goes back to FreeType.
+        """
+        metrics = get_metrics(self)
+        lines = text.split('\n')
+        width = max(int(round(metrics.line_width(line))) for line in lines)
+        return width, len(lines)*self.line_height-LINE_SPACING
+
+    def draw(self, draw, xy, text, line_runs, fill):
+        """Draws multiline text laid out like multiline_text, from the glyph atlases."""
+        (x, y) = xy
+        if line_runs is None:
+            for number, line in enumerate(text.split('\n')):
+                self.atlases[0].draw(draw, (x, y+number*self.line_height), line, fill)
+            return
+        # Every font sits on the primary font's baseline, so mixed lines
+        # don't wobble
+        for number, line in enumerate(line_runs):
+            baseline = y+number*self.line_height+self.ascent
+            for index, offset, run in line:
+                atlas = self.atlases[index]
+                atlas.draw(draw, (x+int(offset), baseline-atlas.ascent), run, fill)
+
+
+def as_chain(font):
+    """Passes a FontChain straight through and wraps a plain font in a chain of one."""
+    if isinstance(font, FontChain):
+        return font
+    return FontChain((font.path,), (font,), (None,))
@@ -0,0 +1,223 @@
+from time import monotonic
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+
+# Defaults for the bot-wide buffer settings
+DEFAULT_CHANNEL_SIZE = 200
+DEFAULT_MAX_CHANNELS = 500
+DEFAULT_IDLE_SECONDS = 60*60
+# A comic without a count covers the conversation leading up to it: nothing
+# older than this...
+CONVERSATION_WINDOW = timedelta(seconds=120)
+# ...and nothing from before a lull longer than this
+CONVERSATION_GAP = timedelta(seconds=20)
+
+
+class CachedMessage(NamedTuple):
+    """The bits of a message a comic actually needs."""
+    id: int
+    author_id: int
+    content: str
+    created_at: datetime
+    edited_at: Optional[datetime]
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            id=message.id,
+            author_id=message.author.id,
+            content=message.content,
+            created_at=message.created_at,
+            edited_at=message.edited_at
+            )
+
+
+def take_conversation(newest_first, since, limit, newer=None):
+    """
+        Walks back through messages (newest first) taking the ones that are
+        part of the same conversation: stops at the first one older than
+        since, the first one sent more than CONVERSATION_GAP before the one
+        after it (newer is the time of whatever comes after the first one, if
+        that counts), or once it has limit of them.
+
+        Returns (messages oldest first, whether it actually hit one of those
+        boundaries rather than just running out of messages).
+    """
+    taken = []
+    if limit < 1:
+        return taken, True
+    for message in newest_first:
+        if message.created_at < since or (newer is not None and newer-message.created_at > CONVERSATION_GAP):
+            break
+        taken.append(message)
+        newer = message.created_at
+        if len(taken) >= limit:
+            break
+    else:
+        taken.reverse()
+        return taken, False
+    taken.reverse()
+    return taken, True
+
+
+class ChannelBuffer(object):
+    """
+        The most recent messages in one channel, oldest first. As long as
+        we've been listening the whole time, there are no holes in it.
+
+        Conversations get split up as messages come in: next to every
+        message we keep the ID of the first message of the conversation
+        it's part of, i.e. the first one after a gap longer than
+        CONVERSATION_GAP, or None if that happened before we were listening.
+    """
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+        self.starts = deque(maxlen=size)
+        self.last_active = monotonic()
+
+    def append(self, message, start=None):
+        if self.messages:
+            if message.created_at-self.messages[-1].created_at > CONVERSATION_GAP:
+                start = message.id
+            else:
+                start = self.starts[-1]
+        self.messages.append(message)
+        self.starts.append(start)
+
+    def refill(self, messages, first_start=None):
+        """Replaces the contents, working the conversations out again after the first message."""
+        self.messages.clear()
+        self.starts.clear()
+        for message in messages:
+            self.append(message, first_start)
+
+    def find(self, message_id):
+        for index, message in enumerate(self.messages):
+            if message.id == message_id:
+                return index
+        return None
+
+
+class MessageBuffer(object):
+    """
+        Per-channel ring buffers of recent messages, fed by the cog's
+        listeners, so comics can usually skip the trip to ctx.history().
+
+        Channels are kept in least-recently-active order. When a new channel
+        shows up, channels that have been idle too long are dropped, and if
+        there are still too many the least recently active one goes.
+    """
+
+    def __init__(self, channel_size=DEFAULT_CHANNEL_SIZE, max_channels=DEFAULT_MAX_CHANNELS,
+                 idle_seconds=DEFAULT_IDLE_SECONDS):
+        self.channel_size = channel_size
+        self.max_channels = max_channels
+        self.idle_seconds = idle_seconds
+        self._channels = OrderedDict()
+
+    def configure(self, channel_size=None, max_channels=None, idle_seconds=None):
+        if channel_size is not None and channel_size != self.channel_size:
+            self.channel_size = channel_size
+            for channel_id, buffer in self._channels.items():
+                resized = ChannelBuffer(channel_size)
+                resized.messages.extend(buffer.messages)
+                resized.starts.extend(buffer.starts)
+                resized.last_active = buffer.last_active
+                self._channels[channel_id] = resized
+        if max_channels is not None:
+            self.max_channels = max_channels
+        if idle_seconds is not None:
+            self.idle_seconds = idle_seconds
+        self._evict()
+
+    def _evict(self):
+        cutoff = monotonic()-self.idle_seconds
+        # Oldest activity is at the front, so we can stop at the first
+        # channel that's still active
+        while self._channels:
+            channel_id, buffer = next(iter(self._channels.items()))
+            if buffer.last_active >= cutoff and len(self._channels) <= self.max_channels:
+                break
+            del self._channels[channel_id]
+
+    def add(self, message):
+        channel_id = message.channel.id
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = self._channels[channel_id] = ChannelBuffer(self.channel_size)
+            self._evict()
+        else:
+            self._channels.move_to_end(channel_id)
+            buffer.last_active = monotonic()
+        buffer.append(CachedMessage.from_message(message))
+
+    def edit(self, channel_id, message_id, content, edited_at):
+        buffer = self._channels.get(channel_id)
+        index = buffer.find(message_id) if buffer else None
+        if index is not None:
+            buffer.messages[index] = buffer.messages[index]._replace(content=content, edited_at=edited_at)
+
+    def delete(self, channel_id, message_ids):
+        buffer = self._channels.get(channel_id)
+        if buffer:
+            kept = [
+                (message, start) for message, start in zip(buffer.messages, buffer.starts)
+                if message.id not in message_ids
+                ]
+            # Deleting a message can only make gaps longer, so if the oldest
+            # one we're keeping started a conversation it still does.
+            # Anything else about it we can't vouch for anymore
+            first_start = kept[0][1] if kept and kept[0][0].id == kept[0][1] else None
+            buffer.refill([message for message, _ in kept], first_start)
+
+    def clear(self):
+        """Forgets everything, e.g. after a disconnect when we might have missed messages."""
+        self._channels.clear()
+
+    def get(self, channel_id, message_id):
+        buffer = self._channels.get(channel_id)
+        index = buffer.find(message_id) if buffer else None
+        return buffer.messages[index] if index is not None else None
+
+    def before(self, channel_id, anchor_id, count):
+        """
+            The count messages right before anchor_id, oldest first, or None
+            if the buffer doesn't reach back that far.
+        """
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return None
+        # Snowflakes go up over time, so everything older than the anchor
+        # has a smaller ID
+        older = [message for message in buffer.messages if message.id < anchor_id]
+        if len(older) < count:
+            return None
+        return older[len(older)-count:]
+
+    def conversation(self, channel_id, anchor_id, since, limit, newer=None):
+        """
+            The messages right before anchor_id that are part of the same
+            conversation, oldest first (see take_conversation), or None if
+            the buffer doesn't reach back far enough to tell where it starts.
+        """
+        if limit < 1:
+            return []
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return None
+        messages = buffer.messages
+        # The anchor's almost always the newest message, or close to it
+        end = len(messages)
+        while end and messages[end-1].id >= anchor_id:
+            end -= 1
+        taken, found_start = take_conversation(
+            (messages[index] for index in range(end-1, -1, -1)), since, limit, newer
+            )
+        # Running out of buffer is fine as long as we saw the conversation
+        # start, since then there's nothing older to go get
+        if not found_start and not (taken and buffer.starts[end-1] == taken[0].id):
+            return None
+        return taken
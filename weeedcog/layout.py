@@ -0,0 +1,189 @@
+"""
+    Pure, synchronous layout for comics.
+
+    group_panels turns sanitized messages into comic data (who says what in
+    which panel), and layout_comic turns comic data into a plan of where every
+    text block and character goes. Each message is wrapped and measured
+    exactly once, and the renderer only ever consumes the finished plan.
+"""
+
+from typing import List, NamedTuple, Optional
+from .fonts import as_chain
+from .textwrapper import wrap_many
+
+
+# These have been the defaults since the dawn of time. Do we ever want
+# to make them configurable? That would require some other changes too.
+PANEL_WIDTH = 450
+PANEL_HEIGHT = 300
+# Panels are 450px wide, so we make the text 300 wide to keep the
+# noticable offset of the left and right text blocks
+# This is our global text block width
+TEXT_WIDTH = 300
+# This is the top and sides margin size for text and characters
+# TODO: make this configurable per-server and take into account how
+# changing this changes text and char rendering
+TEXT_BUFFER = 10
+# Characters never get squished shorter than this, even under tall text
+MIN_CHAR_HEIGHT = 150
+# Wrapped text taller than this many lines gets a panel to itself
+MAX_SHARED_LINES = 3
+
+
+class ComicEntry(NamedTuple):
+    """One sanitized message."""
+    author_id: int
+    text: str
+
+
+class SideLayout(NamedTuple):
+    author_id: int
+    # The wrapped text, ready for multiline_text
+    text: str
+    # Each line's (font index, x offset, text) runs, for text that needs
+    # fallback fonts. None when it's all in the primary font.
+    runs: Optional[tuple]
+    # (x, y, width, height) of the text block on the canvas
+    text_box: tuple
+    # (left, top, right, bottom) of the space the character is fit into. The
+    # character sits on the bottom edge, against the outer side of the panel.
+    char_box: tuple
+    # Right side characters face left
+    mirrored: bool
+
+
+class PanelLayout(NamedTuple):
+    top: int
+    left: SideLayout
+    right: Optional[SideLayout]
+
+
+class ComicLayout(NamedTuple):
+    width: int
+    height: int
+    panels: List[PanelLayout]
+
+
+def group_panels(entries, font, text_width=TEXT_WIDTH):
+    """Convert a list of ComicEntry to comic data. font can be a FontChain."""
+    wrapped = wrap_many([entry.text for entry in entries], font, text_width)
+    comic = []
+    panel = []
+    # Using enumerate so we can carry an index for lookahead, lookbehind
+    for index, entry in enumerate(entries):
+        if len(panel) == 1:  # We're looking at the "right" side
+            # Blank panel if last author and this one are the same
+            # Blank panel if last message height is over 3 lines tall
+            if entry.author_id == entries[index-1].author_id or \
+                    len(wrapped[index-1].split('\n')) > MAX_SHARED_LINES:
+                # So in this case we want to only have one action
+                # in the panel instead of two because of either
+                # a monologue or a big text block
+                panel.append({'char': None, 'text': None})
+                comic.append(panel)
+                panel = []
+                panel.append({
+                    'text': entry.text,
+                    'wrapped': wrapped[index],
+                    'id': entry.author_id
+                    })
+                continue
+        panel.append({
+            'text': entry.text,
+            'wrapped': wrapped[index],
+            'id': entry.author_id
+            })
+        if len(panel) == 2:
+            comic.append(panel)
+            panel = []
+    # Now we check for any stragglers and append them.
+    if len(panel) > 0:
+        comic.append(panel)
+    return comic
+
+
+def messages_to_comicdata(guild, messages, font, sanitizer, text_width=TEXT_WIDTH):
+    """
+        Sanitizes messages (anything shaped like a CachedMessage) and groups
+        them into comic data. guild only needs get_member, get_role and
+        get_channel, so this works the same on a real guild and on a message
+        dump.
+    """
+    entries = [
+        ComicEntry(author_id=message.author_id, text=sanitizer.sanitize(guild, message))
+        for message in messages
+    ]
+    return group_panels(entries, font, text_width)
+
+
+def _has_right_side(panel):
+    return len(panel) > 1 and bool(panel[1]['text'])
+
+
+def layout_panel(panel, font, top=0):
+    """Works out where everything in one panel of comic data goes."""
+    fonts = as_chain(font)
+    text_buffer = TEXT_BUFFER
+    bottom_edge = top+PANEL_HEIGHT
+    # Now we find out how tall the left side text is so we can scale
+    # the chars properly beneath it.
+    left_text = panel[0]['wrapped']
+    left_runs = fonts.line_runs(left_text)
+    (left_text_width, left_text_height) = fonts.multiline_size(left_text)
+    # We also need to calculate the right side text height because we
+    # have the two chars scaled to be as tall as the space left beneath
+    # both of the rendered text blocks
+    if _has_right_side(panel):
+        right_text = panel[1]['wrapped']
+        right_runs = fonts.line_runs(right_text)
+        (right_text_width, right_text_height) = fonts.multiline_size(right_text)
+    else:
+        right_text_height = 0
+    # We want to thumbnail the characters to fit between the bottom of
+    # the text and the bottom of the panel, taking into account
+    # buffers at the top and bottom
+    char_height = PANEL_HEIGHT-(left_text_height+(text_buffer*2))-(text_buffer*2)-right_text_height
+    if char_height < MIN_CHAR_HEIGHT:
+        char_height = MIN_CHAR_HEIGHT
+    char_width = (PANEL_WIDTH // 2)-(text_buffer*2)
+    left = SideLayout(
+        author_id=panel[0]['id'],
+        text=left_text,
+        runs=left_runs,
+        text_box=(text_buffer, top+text_buffer, left_text_width, left_text_height),
+        char_box=(text_buffer, bottom_edge-char_height, text_buffer+char_width, bottom_edge),
+        mirrored=False
+        )
+    right = None
+    if _has_right_side(panel):
+        # The right side text sits below the left text, pushed up against
+        # the right edge of the panel
+        right = SideLayout(
+            author_id=panel[1]['id'],
+            text=right_text,
+            runs=right_runs,
+            text_box=(
+                PANEL_WIDTH-(right_text_width+text_buffer),
+                top+text_buffer+left_text_height+text_buffer,
+                right_text_width,
+                right_text_height
+                ),
+            char_box=(
+                PANEL_WIDTH-(text_buffer+char_width),
+                bottom_edge-char_height,
+                PANEL_WIDTH-text_buffer,
+                bottom_edge
+                ),
+            mirrored=True
+            )
+    return PanelLayout(top=top, left=left, right=right)
+
+
+def layout_comic(comic, font):
+    """Turns comic data into a ComicLayout. font can be a FontChain."""
+    fonts = as_chain(font)
+    panels = [
+        layout_panel(panel, fonts, top=PANEL_HEIGHT*index)
+        for index, panel in enumerate(comic)
+    ]
+    return ComicLayout(width=PANEL_WIDTH, height=PANEL_HEIGHT*len(panels), panels=panels)
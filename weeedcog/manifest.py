@@ -0,0 +1,89 @@
+from os import scandir
+from threading import RLock
+from typing import NamedTuple, Optional
+from PIL import Image
+
+
+# The bundled asset folders we index, by the kind of asset in them
+ASSET_KINDS = ("background", "char", "font")
+# How often the cog checks the asset folders for changes
+POLL_SECONDS = 60
+
+
+class AssetInfo(NamedTuple):
+    kind: str
+    name: str
+    # (width, height), or None for fonts
+    dimensions: Optional[tuple]
+    nbytes: int
+    mtime: float
+
+
+def _read_info(kind, name, path, stat):
+    dimensions = None
+    if kind != "font":
+        # Only reads the header, but it's enough to tell it's an image we
+        # can open
+        with Image.open(path) as image:
+            dimensions = image.size
+    return AssetInfo(
+        kind=kind, name=name, dimensions=dimensions,
+        nbytes=stat.st_size, mtime=stat.st_mtime
+        )
+
+
+class AssetManifest(object):
+    """
+        An index of every bundled background, character and font, so the cog
+        can validate and list assets without going to the filesystem.
+
+        It's built once when the cog loads. refresh() re-reads the folders
+        and only opens files that are new or whose size or mtime changed,
+        returning what changed so the caches can drop stale copies.
+    """
+
+    def __init__(self, datapath):
+        self.datapath = datapath
+        # kind -> {name: AssetInfo}
+        self._assets = {kind: {} for kind in ASSET_KINDS}
+        # kind -> sorted tuple of names, for sampling
+        self._names = {kind: () for kind in ASSET_KINDS}
+        self._lock = RLock()
+        self.refresh()
+
+    def refresh(self):
+        """Re-scans the asset folders, returning [(kind, name)] of everything added, changed or removed."""
+        changed = []
+        for kind in ASSET_KINDS:
+            with self._lock:
+                previous = dict(self._assets[kind])
+            current = {}
+            with scandir(f"{self.datapath}/{kind}") as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    info = previous.get(entry.name)
+                    if info is None or info.mtime != stat.st_mtime or info.nbytes != stat.st_size:
+                        try:
+                            info = _read_info(kind, entry.name, entry.path, stat)
+                        except OSError:
+                            # Not something we can use, or it's still being copied in
+                            continue
+                        changed.append((kind, entry.name))
+                    current[entry.name] = info
+            changed.extend((kind, name) for name in previous if name not in current)
+            with self._lock:
+                self._assets[kind] = current
+                self._names[kind] = tuple(sorted(current))
+        return changed
+
+    def names(self, kind):
+        return self._names[kind]
+
+    def has(self, kind, name):
+        return name in self._assets[kind]
+
+    def stamps(self, kind, names):
+        """[kind, name, mtime] for each name, for telling apart versions of the same file."""
+        return [[kind, name, self._assets[kind][name].mtime if name in self._assets[kind] else None] for name in names]
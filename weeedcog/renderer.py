@@ -0,0 +1,461 @@
+import sys
+from asyncio import get_running_loop
+from functools import partial
+from multiprocessing import get_context
+from os.path import abspath, dirname
+from time import perf_counter
+from threading import RLock
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, ImageDraw
+from .layout import PANEL_HEIGHT
+from .assets import get_asset_cache, warm_asset_cache
+from .sprites import get_sprite_store
+from .encoder import DEFAULT_BUDGET, ENCODINGS, STREAM_HEIGHT, STREAMED_ENCODINGS, encode_comic, make_palette, stream_png
+from .compositor import BlendTile, NumpyCanvas
+
+
+EXECUTOR_MODES = ("process", "thread")
+# Bump this whenever a change here makes the same comic come out looking
+# different, so cached comics from the old renderer stop getting served
+RENDER_VERSION = 6
+
+# At most this many panels get drawn to pick the palette for a streamed
+# palette PNG
+PALETTE_PANELS = 16
+
+# Threads for drawing panels in parallel, one pool per size per process
+_panel_pools = {}
+_panel_pools_lock = RLock()
+
+
+def _panel_pool(threads):
+    with _panel_pools_lock:
+        if threads not in _panel_pools:
+            _panel_pools[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="weeedcog-panel")
+        return _panel_pools[threads]
+
+
+def _char_thumb(sprites, char, side):
+    (left, top, right, bottom) = side.char_box
+    # The sprite store hands back a thumbnail that's already scaled (and
+    # mirrored for the right side), so this is just a lookup
+    return sprites.thumbnail(char, (right-left, bottom-top), mirrored=side.mirrored)
+
+
+def _char_position(thumb, side, top):
+    (left, _, right, bottom) = side.char_box
+    if side.mirrored:
+        left = right-thumb.width
+    return left, bottom-top-thumb.height
+
+
+def _paste_char(canvas, thumb, side, top):
+    canvas.paste(thumb, _char_position(thumb, side, top), mask=thumb)
+
+
+def _draw_text(draw, fonts, side, top):
+    (x, y, _, _) = side.text_box
+    # TODO: Maybe make the text color configurable too?
+    fonts.draw(draw, (x, y-top), side.text, side.runs, fill="white")
+
+
+def draw_panel(buffer, panel, background, fonts, sprites, characters, spans=None):
+    """
+        Draws one panel of a layout into buffer, a panel-sized RGBA image,
+        on top of background, a tile the same size as the buffer.
+        Layout coordinates are for the whole comic, so everything gets shifted
+        up by the panel's top edge. Time spent getting sprites is added to
+        spans["sprites"] if we're given a spans dict.
+    """
+    top = panel.top
+    sides = [side for side in (panel.left, panel.right) if side]
+    start = perf_counter()
+    thumbs = [_char_thumb(sprites, characters[side.author_id], side) for side in sides]
+    if spans is not None:
+        spans["sprites"] += perf_counter()-start
+    # Paste in our background first. It covers the whole buffer, so this
+    # also wipes out whatever the last panel left behind.
+    buffer.paste(background, (0, 0))
+    draw = ImageDraw.Draw(buffer)
+    # Left side character, then its text
+    _paste_char(buffer, thumbs[0], panel.left, top)
+    _draw_text(draw, fonts, panel.left, top)
+    if not panel.right:
+        return buffer
+    # Time for right side char and text
+    _paste_char(buffer, thumbs[1], panel.right, top)
+    _draw_text(draw, fonts, panel.right, top)
+    # Now we need to draw a line to separate panels
+    # TODO: don't draw this line on the last panel
+    draw.line([(0, PANEL_HEIGHT-1), (buffer.width, PANEL_HEIGHT-1)], width=4, fill="black")
+    return buffer
+
+
+def _draw_panel_copy(size, panel, background, fonts, sprites, characters):
+    """draw_panel into a buffer of its own, for drawing in a thread. Returns (image, sprite seconds)."""
+    spans = {"sprites": 0.0}
+    image = draw_panel(Image.new("RGBA", size), panel, background, fonts, sprites, characters, spans)
+    return image, spans["sprites"]
+
+
+def render_panels(datapath, layout, characters, backgrounds, font_name, sprite_path=None, spans=None, threads=1):
+    """
+        Yields each panel of the comic in order, drawn into a single reusable
+        panel-sized buffer. Whatever's consuming the panels has to be done
+        with one before asking for the next.
+
+        With threads > 1, panels get drawn that many at a time, each into its
+        own buffer, a few panels ahead of whatever's consuming them. Most of
+        drawing is PIL pasting, which lets go of the GIL, and panels don't
+        depend on each other, so they come out exactly the same either way.
+
+        backgrounds is one background filename per panel, or a single
+        filename to use for all of them.
+    """
+    assets = get_asset_cache(datapath)
+    sprites = get_sprite_store(datapath, sprite_path)
+    if isinstance(backgrounds, str):
+        backgrounds = [backgrounds]*len(layout.panels)
+    fonts = assets.font_chain(font_name)
+    size = (layout.width, PANEL_HEIGHT)
+    if threads > 1:
+        yield from _render_panels_parallel(
+            assets, sprites, fonts, size, layout, characters, backgrounds, spans, threads
+            )
+        return
+    buffer = Image.new("RGBA", size)
+    for panel, background in zip(layout.panels, backgrounds):
+        tile = assets.background(background, buffer.size)
+        yield draw_panel(buffer, panel, tile, fonts, sprites, characters, spans)
+
+
+def _render_panels_parallel(assets, sprites, fonts, size, layout, characters, backgrounds, spans, threads):
+    pool = _panel_pool(threads)
+    jobs = iter(zip(layout.panels, backgrounds))
+    pending = deque()
+
+    def submit_next():
+        job = next(jobs, None)
+        if job:
+            (panel, background) = job
+            tile = assets.background(background, size)
+            pending.append(pool.submit(_draw_panel_copy, size, panel, tile, fonts, sprites, characters))
+
+    # Only run a couple of panels per thread ahead, so a long comic doesn't
+    # end up with every panel sitting in memory at once
+    for _ in range(threads*2):
+        submit_next()
+    while pending:
+        image, sprite_seconds = pending.popleft().result()
+        if spans is not None:
+            spans["sprites"] += sprite_seconds
+        submit_next()
+        yield image
+
+
+def _text_stays_put(panel, fonts, right_char):
+    """
+        Whether drawing this panel's text last, straight onto the whole comic,
+        comes out the same as drawing the panel by itself: the text can't
+        spill into the separator or the next panel, and the left text can't
+        run under the right character (which gets pasted over it normally).
+        Everything's given a line of slack for descenders.
+    """
+    slack = fonts.line_height
+    bottom = panel.top+PANEL_HEIGHT-2
+    for side in (panel.left, panel.right):
+        if side and side.text_box[1]+side.text_box[3]+slack > bottom:
+            return False
+    if right_char:
+        (x, y, width, height) = panel.left.text_box
+        (left, top, right, bottom) = right_char
+        if x-slack < right and left < x+width+slack and y-slack < bottom and top < y+height+slack:
+            return False
+    return True
+
+
+def composite_comic(datapath, layout, characters, backgrounds, font_name, sprite_path=None, spans=None):
+    """
+        Draws the whole comic at once with the NumPy compositor and returns it
+        as one RGBA image, identical to what render_panels draws.
+
+        Backgrounds, sprites and separators all go into a NumpyCanvas, then
+        PIL draws the text over the top. The odd panel whose text would come
+        out differently when drawn last (see _text_stays_put) gets drawn the
+        usual way and pasted over its spot instead.
+    """
+    assets = get_asset_cache(datapath)
+    sprites = get_sprite_store(datapath, sprite_path)
+    if isinstance(backgrounds, str):
+        backgrounds = [backgrounds]*len(layout.panels)
+    fonts = assets.font_chain(font_name)
+    size = (layout.width, PANEL_HEIGHT)
+    canvas = NumpyCanvas(layout.width, layout.height, PANEL_HEIGHT)
+    # Every panel using the same background gets it in one write
+    by_background = {}
+    for index, background in enumerate(backgrounds):
+        by_background.setdefault(background, []).append(index)
+    for background, indexes in by_background.items():
+        canvas.fill_panels(indexes, assets.background(background, size))
+
+    def blend_tile(char, side):
+        thumb = _char_thumb(sprites, char, side)
+        (left, top, right, bottom) = side.char_box
+        key = ("blend", char, (right-left, bottom-top, side.mirrored))
+        return thumb, assets.get(key, lambda: _blend_loader(thumb))
+
+    redraw = []
+    separator_rows = []
+    for index, panel in enumerate(layout.panels):
+        right_char = None
+        start = perf_counter()
+        tiles = [(side, blend_tile(characters[side.author_id], side)) for side in (panel.left, panel.right) if side]
+        if spans is not None:
+            spans["sprites"] += perf_counter()-start
+        for side, (thumb, tile) in tiles:
+            (x, y) = _char_position(thumb, side, 0)
+            canvas.blend(tile, x, y)
+            if side.mirrored:
+                right_char = (x, y, x+thumb.width, y+thumb.height)
+        if panel.right:
+            separator_rows.extend((panel.top+PANEL_HEIGHT-2, panel.top+PANEL_HEIGHT-1))
+        if not _text_stays_put(panel, fonts, right_char):
+            redraw.append((index, panel))
+    canvas.fill_rows(separator_rows, (0, 0, 0, 255))
+
+    image = canvas.image()
+    draw = ImageDraw.Draw(image)
+    redrawn = set(index for index, _ in redraw)
+    for index, panel in enumerate(layout.panels):
+        if index in redrawn:
+            continue
+        for side in (panel.left, panel.right):
+            if side:
+                _draw_text(draw, fonts, side, 0)
+    if redraw:
+        buffer = Image.new("RGBA", size)
+        for index, panel in redraw:
+            tile = assets.background(backgrounds[index], size)
+            image.paste(draw_panel(buffer, panel, tile, fonts, sprites, characters, spans), (0, panel.top))
+    return image
+
+
+def _blend_loader(thumb):
+    tile = BlendTile(thumb)
+    return tile, tile.nbytes
+
+
+def _stream_encoding(layout, encodings):
+    """
+        The encoding to stream the comic out in a panel at a time, or None
+        if it should be put together as one canvas for encode_comic.
+    """
+    if tuple(encodings) == ("png",):
+        return "png"
+    if layout.height > STREAM_HEIGHT:
+        return next((encoding for encoding in STREAMED_ENCODINGS if encoding in encodings), "png")
+    return None
+
+
+def _palette_panels(layout, characters, backgrounds, limit=PALETTE_PANELS):
+    """Indexes of the first few panels that between them show every character and background."""
+    seen = set()
+    picked = []
+    for index, panel in enumerate(layout.panels):
+        shown = {characters[side.author_id] for side in (panel.left, panel.right) if side}
+        shown.add(backgrounds[index])
+        if not shown <= seen:
+            seen |= shown
+            picked.append(index)
+            if len(picked) >= limit:
+                break
+    return picked
+
+
+def comic_palette(datapath, layout, characters, backgrounds, font_name, sprite_path=None):
+    """
+        A palette for streaming the comic out as a palette PNG. It has to be
+        picked before the first panel gets written, so it comes from drawing
+        a sample of panels that has every character and background in it.
+    """
+    picked = _palette_panels(layout, characters, backgrounds)
+    sample_layout = layout._replace(
+        panels=[layout.panels[index] for index in picked], height=PANEL_HEIGHT*len(picked)
+        )
+    sample = Image.new("RGBA", (layout.width, sample_layout.height))
+    panels = render_panels(
+        datapath, sample_layout, characters, [backgrounds[index] for index in picked], font_name, sprite_path
+        )
+    for offset, image in enumerate(panels):
+        sample.paste(image, (0, offset*PANEL_HEIGHT))
+    return make_palette(sample)
+
+
+def _timed(panels, spans):
+    """Passes panels through, adding the time spent drawing each to spans["draw"]."""
+    while True:
+        start = perf_counter()
+        try:
+            image = next(panels)
+        except StopIteration:
+            return
+        spans["draw"] += perf_counter()-start
+        yield image
+
+
+def render_comic(datapath, layout, characters, backgrounds, font_name, invalidations=None, sprite_path=None,
+                 budget=DEFAULT_BUDGET, encodings=ENCODINGS, panel_threads=1, compositor="pil"):
+    """
+        Renders a ComicLayout and encodes it. Returns an EncodedComic in
+        whichever of the allowed encodings came out smallest under budget,
+        along with {stage: seconds} for sprites, draw and encode.
+
+        Everything passed in here is plain data (the layout, a dict of author
+        ID to character filename, and asset filenames, with a background per
+        panel or one for all of them) so that this can be shipped off to a
+        worker process without dragging any discord objects along. All the
+        wrapping and measuring already happened in the layout, so this only
+        has to put pixels where it's told.
+
+        Panels are drawn one at a time into a reusable buffer. When plain PNG
+        is the only allowed encoding they're streamed straight into the PNG
+        writer, so memory stays flat however long the comic is. The other
+        encoders need the whole picture, so for those the panels get pasted
+        into a full canvas first, unless the comic is taller than
+        STREAM_HEIGHT. Those get streamed too, as a palette PNG (see
+        comic_palette) if that's allowed and plain PNG if not, so no comic
+        ever needs a canvas bigger than STREAM_HEIGHT rows. panel_threads > 1
+        draws that many panels at once (see render_panels). With
+        compositor="numpy" the whole comic is drawn in one go by
+        composite_comic instead, which needs the full canvas in memory, so
+        comics too tall to put on one canvas always use the PIL path.
+
+        Fonts, background tiles and sprites come out of this process's asset
+        cache, with character thumbnails from the sprite store (kept on disk
+        under sprite_path, if given). invalidations is the renderer's map of
+        assets that have been swapped out since the cache was filled.
+    """
+    get_asset_cache(datapath).apply_invalidations(invalidations)
+    spans = {"sprites": 0.0, "draw": 0.0, "encode": 0.0}
+    if compositor == "numpy" and layout.height <= STREAM_HEIGHT:
+        start = perf_counter()
+        canvas = composite_comic(datapath, layout, characters, backgrounds, font_name, sprite_path, spans)
+        spans["draw"] = perf_counter()-start-spans["sprites"]
+        if tuple(encodings) == ("png",):
+            encoded = stream_png([canvas], layout.width, layout.height, budget=budget)
+        else:
+            encoded = encode_comic(canvas, budget=budget, encodings=encodings)
+        spans["encode"] = encoded.elapsed
+        return encoded, spans
+    panels = _timed(render_panels(
+        datapath, layout, characters, backgrounds, font_name, sprite_path, spans, panel_threads
+        ), spans)
+    encoding = _stream_encoding(layout, encodings)
+    if encoding:
+        palette = None
+        palette_seconds = 0.0
+        if encoding == "palette":
+            start = perf_counter()
+            if isinstance(backgrounds, str):
+                backgrounds = [backgrounds]*len(layout.panels)
+            palette = comic_palette(datapath, layout, characters, backgrounds, font_name, sprite_path)
+            palette_seconds = perf_counter()-start
+        encoded = stream_png(panels, layout.width, layout.height, budget=budget, palette=palette)
+        # Drawing happens inside the streaming encoder's loop
+        spans["encode"] = encoded.elapsed-spans["draw"]+palette_seconds
+    else:
+        canvas = Image.new("RGBA", (layout.width, layout.height))
+        for panel, image in zip(layout.panels, panels):
+            canvas.paste(image, (0, panel.top))
+        encoded = encode_comic(canvas, budget=budget, encodings=encodings)
+        spans["encode"] = encoded.elapsed
+    # Sprite lookups happen while drawing, so don't count them twice. When
+    # panels are drawn in parallel, draw is how long we waited on them.
+    spans["draw"] = max(0.0, spans["draw"]-spans["sprites"])
+    return encoded, spans
+
+
+def _spawn_context():
+    """
+        Render workers get started fresh rather than forked, since forking
+        the bot copies its event loop and whatever locks its other threads
+        happen to be holding. A fresh worker has to import weeedcog by name
+        though, and Red loads cogs straight from their spec without putting
+        the cog folder on sys.path, so we put it there for them to find.
+    """
+    cogs_path = dirname(dirname(abspath(__file__)))
+    if cogs_path not in sys.path:
+        sys.path.append(cogs_path)
+    return get_context("spawn")
+
+
+class ComicRenderer(object):
+    """
+        Runs render_comic in an executor so that all the PIL work happens
+        off the bot's event loop. Every other cog (and every other listener,
+        like bandname's on_message) keeps getting serviced while a comic is
+        being drawn.
+    """
+
+    def __init__(self, datapath, workers=2, mode="process", warm_backgrounds=(), sprite_path=None,
+                 panel_threads=1, compositor="pil"):
+        self.datapath = datapath
+        self.sprite_path = sprite_path
+        self.workers = workers
+        self.mode = mode
+        # How many threads each render draws panels with
+        self.panel_threads = panel_threads
+        # "pil" or "numpy", see compositor.py
+        self.compositor = compositor
+        # None means every background
+        self.warm_backgrounds = tuple(warm_backgrounds) if warm_backgrounds is not None else None
+        # (asset type, filename) -> generation, shipped with every render so
+        # worker processes can drop assets the cog has invalidated
+        self._invalidations = {}
+        self._generation = 0
+        self._executor = self._make_executor()
+
+    def _make_executor(self):
+        if self.mode == "thread":
+            # Threads share this process's asset cache, which the cog warms
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="weeedcog-render")
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=_spawn_context(),
+            initializer=warm_asset_cache,
+            initargs=(self.datapath, self.warm_backgrounds)
+            )
+
+    def invalidate(self, kind, name):
+        """Drops an asset from our cache now, and from each worker's on its next render."""
+        self._generation += 1
+        self._invalidations[(kind, name)] = self._generation
+        get_asset_cache(self.datapath).apply_invalidations({(kind, name): self._generation})
+
+    def configure(self, workers=None, mode=None):
+        """Swaps in a new executor. Renders already in flight finish on the old one."""
+        if workers is not None:
+            self.workers = workers
+        if mode is not None:
+            if mode not in EXECUTOR_MODES:
+                raise ValueError(f"Unknown executor mode '{mode}'")
+            self.mode = mode
+        old_executor = self._executor
+        self._executor = self._make_executor()
+        old_executor.shutdown(wait=False)
+
+    async def render(self, layout, characters, backgrounds, font_name,
+                     budget=DEFAULT_BUDGET, encodings=ENCODINGS):
+        """Renders in the executor, returning (EncodedComic, worker-side spans)."""
+        loop = get_running_loop()
+        job = partial(
+            render_comic, self.datapath, layout, characters, backgrounds, font_name,
+            invalidations=dict(self._invalidations), sprite_path=self.sprite_path,
+            budget=budget, encodings=encodings, panel_threads=self.panel_threads,
+            compositor=self.compositor
+            )
+        return await loop.run_in_executor(self._executor, job)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,65 @@
+import re
+from threading import RLock
+from collections import OrderedDict
+
+
+# Every kind of Discord markup we rewrite, as one pattern so each message
+# only gets scanned once
+MARKUP_REGEX = re.compile(
+    r"<(?:"
+    r"@!?(?P<member>[0-9]+)"
+    r"|@&(?P<role>[0-9]+)"
+    r"|#(?P<channel>[0-9]+)"
+    r"|a?(?P<emoji>:[0-9a-zA-Z_]+:)[0-9]+"
+    r")>"
+)
+# How many sanitized messages we hang on to
+CACHE_SIZE = 4096
+
+
+def sanitize_text(guild, text):
+    """
+        Replaces member and role mentions with their names, channel mentions
+        with #channel-name, and custom emoji with :emojiname:. Anything that
+        can't be looked up (someone who left, a deleted channel) gets a
+        placeholder instead of blowing up.
+    """
+    def replace(match):
+        if match.group("member"):
+            member = guild.get_member(int(match.group("member")))
+            return member.display_name if member else "unknown-user"
+        if match.group("role"):
+            role = guild.get_role(int(match.group("role")))
+            return f"@{role.name}" if role else "@deleted-role"
+        if match.group("channel"):
+            channel = guild.get_channel(int(match.group("channel")))
+            return f"#{channel.name}" if channel else "#deleted-channel"
+        return match.group("emoji")
+    # Most messages don't have any markup at all
+    if "<" not in text:
+        return text
+    return MARKUP_REGEX.sub(replace, text)
+
+
+class Sanitizer(object):
+    """sanitize_text with an LRU of results keyed by message ID and edit time."""
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = RLock()
+
+    def sanitize(self, guild, message):
+        """Sanitizes a message's content; anything with id and edited_at will do."""
+        key = (message.id, message.edited_at)
+        with self._lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+                return text
+        text = sanitize_text(guild, message.content)
+        with self._lock:
+            self._cache[key] = text
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return text
@@ -0,0 +1,131 @@
+from asyncio import CancelledError, get_running_loop, shield
+from collections import OrderedDict, deque
+
+
+# Defaults for the bot-wide render queue settings
+DEFAULT_CONCURRENCY = 2
+DEFAULT_GUILD_DEPTH = 3
+
+
+class QueueFull(Exception):
+    """Raised when a guild already has as many comics queued as it's allowed."""
+
+
+class RenderJob(object):
+    def __init__(self, guild_id, key, factory, future):
+        self.guild_id = guild_id
+        self.key = key
+        self.factory = factory
+        self.future = future
+
+
+class Ticket(object):
+    """
+        What submit() hands back. position is how many jobs are ahead of
+        this one (0 means it's already running).
+    """
+
+    def __init__(self, future, position):
+        self._future = future
+        self.position = position
+
+    async def result(self):
+        # Shielded so one impatient requester getting cancelled doesn't
+        # cancel the render for everyone else waiting on it
+        return await shield(self._future)
+
+
+class RenderScheduler(object):
+    """
+        Sits in front of the renderer so a channel full of `weeed comic 80`
+        doesn't try to draw everything at once.
+
+        At most concurrency jobs run at a time. Everything else waits in a
+        queue per guild, at most guild_depth deep, and guilds take turns
+        round-robin so one busy guild can't starve the rest. Jobs with the
+        same key (the comic cache key) are coalesced, so identical requests
+        share one render.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, guild_depth=DEFAULT_GUILD_DEPTH):
+        self.concurrency = concurrency
+        self.guild_depth = guild_depth
+        self.running = 0
+        # guild ID -> deque of RenderJobs, in the order guilds get their turn
+        self._queues = OrderedDict()
+        # key -> RenderJob, for everything queued or running
+        self._jobs = {}
+        self._running_keys = set()
+
+    def configure(self, concurrency=None, guild_depth=None):
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if guild_depth is not None:
+            self.guild_depth = guild_depth
+        self._pump()
+
+    def queued(self, guild_id=None):
+        if guild_id is None:
+            return sum(len(queue) for queue in self._queues.values())
+        return len(self._queues.get(guild_id, ()))
+
+    def _dispatch_order(self):
+        """Every queued job, in the order the round-robin will start them."""
+        queues = [list(queue) for queue in self._queues.values()]
+        order = []
+        for turn in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[turn] for queue in queues if turn < len(queue))
+        return order
+
+    def _position(self, job):
+        if job.key in self._running_keys:
+            return 0
+        return self._dispatch_order().index(job)+1
+
+    def submit(self, guild_id, key, factory):
+        """
+            Queues factory, a coroutine function, to run under key. Returns a
+            Ticket, or raises QueueFull if the guild's queue is full.
+        """
+        job = self._jobs.get(key)
+        if job is not None:
+            return Ticket(job.future, self._position(job))
+        if self.queued(guild_id) >= self.guild_depth:
+            raise QueueFull()
+        job = RenderJob(guild_id, key, factory, get_running_loop().create_future())
+        self._jobs[key] = job
+        self._queues.setdefault(guild_id, deque()).append(job)
+        self._pump()
+        return Ticket(job.future, self._position(job))
+
+    def _pump(self):
+        while self.running < self.concurrency and self._queues:
+            # Take the next job from whichever guild's turn it is, then send
+            # that guild to the back of the line
+            guild_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+            self.running += 1
+            self._running_keys.add(job.key)
+            get_running_loop().create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            result = await job.factory()
+        except CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as error:
+            job.future.set_exception(error)
+            # Nobody might be awaiting it if every requester gave up
+            job.future.exception()
+        else:
+            job.future.set_result(result)
+        finally:
+            self.running -= 1
+            self._running_keys.discard(job.key)
+            del self._jobs[job.key]
+            self._pump()
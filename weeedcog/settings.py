@@ -0,0 +1,22 @@
+from typing import NamedTuple, Optional
+
+
+class GuildSettings(NamedTuple):
+    """
+        Immutable snapshot of one guild's weeedcog settings.
+
+        The cog reads a guild's settings out of Config once, keeps the
+        snapshot around, and swaps in an updated copy whenever a wset command
+        writes a new value. Rendering a comic never has to touch Config.
+    """
+    max_messages: int
+    background_image: str
+    background_mode: str
+    comic_text: Optional[str]
+    font: str
+    encoding: str
+
+    @classmethod
+    def from_config(cls, data):
+        """Builds a snapshot from Config's guild data, ignoring unknown keys."""
+        return cls(**{field: data[field] for field in cls._fields})
@@ -0,0 +1,85 @@
+from os import getpid, makedirs, replace
+from os.path import exists, getmtime
+from threading import get_ident
+from PIL import Image, ImageOps
+from .assets import get_asset_cache, _image_bytes
+
+
+# Bump this if the way sprites get trimmed or scaled changes, so old
+# thumbnails on disk stop getting used
+SPRITE_VERSION = 1
+
+
+# One store per (data path, cache dir) per process, same as the asset cache
+_stores = {}
+
+
+def get_sprite_store(datapath, cache_dir=None):
+    """Returns this process's SpriteStore."""
+    key = (datapath, cache_dir)
+    if key not in _stores:
+        _stores[key] = SpriteStore(datapath, cache_dir)
+    return _stores[key]
+
+
+class SpriteStore(object):
+    """
+        Ready-to-paste character thumbnails.
+
+        Sprites are converted to RGBA and trimmed down to their alpha bounding
+        box once, then thumbnailed to each character box size the layout asks
+        for, in both orientations. Thumbnails live in the asset cache and,
+        if we're given a cache_dir, on disk too so worker processes and
+        restarts don't redo the resampling. After the first time a character
+        shows up at a given size, pasting it is just a lookup.
+    """
+
+    def __init__(self, datapath, cache_dir=None):
+        self.datapath = datapath
+        self.cache_dir = cache_dir
+        self.assets = get_asset_cache(datapath)
+        if cache_dir:
+            makedirs(cache_dir, exist_ok=True)
+
+    def trimmed(self, name):
+        """The sprite as RGBA, with fully transparent borders cropped off."""
+        def loader():
+            image = self.assets.char(name).convert("RGBA")
+            bbox = image.getchannel("A").getbbox()
+            if bbox:
+                image = image.crop(bbox)
+            return image, _image_bytes(image)
+        return self.assets.get(("trimmed", name, None), loader)
+
+    def _disk_path(self, name, size, mirrored):
+        side = "r" if mirrored else "l"
+        return f"{self.cache_dir}/{name}.v{SPRITE_VERSION}.{size[0]}x{size[1]}.{side}.png"
+
+    def _build(self, name, size, mirrored):
+        path = None
+        if self.cache_dir:
+            path = self._disk_path(name, size, mirrored)
+            source = f"{self.datapath}/char/{name}"
+            # Only trust a thumbnail on disk if it's newer than the sprite
+            if exists(path) and getmtime(path) >= getmtime(source):
+                image = Image.open(path)
+                image.load()
+                return image
+        thumb = self.trimmed(name).copy()
+        thumb.thumbnail(size)
+        if mirrored:
+            thumb = ImageOps.mirror(thumb)
+        if path:
+            # Write to a temp file and swap it in, since several workers
+            # might be building the same thumbnail at once
+            tmp_path = f"{path}.{getpid()}.{get_ident()}.tmp"
+            thumb.save(tmp_path, format="PNG")
+            replace(tmp_path, path)
+        return thumb
+
+    def thumbnail(self, name, size, mirrored=False):
+        """The sprite fit inside size=(width, height), facing left if mirrored."""
+        def loader():
+            thumb = self._build(name, size, mirrored)
+            return thumb, _image_bytes(thumb)
+        return self.assets.get(("sprite", name, (size[0], size[1], mirrored)), loader)
@@ -3,7 +3,157 @@
     Found posted to stackexchange here: https://stackoverflow.com/questions/7698231/python-pil-draw-multiline-text-on-image
 """
 
-from PIL import Image, ImageDraw
+from string import ascii_letters, digits
+from threading import RLock
+from collections import OrderedDict
+
+
+# How many distinct words we remember the width of, per font
+WORD_CACHE_SIZE = 8192
+# Characters we check every pair of for kerning and ligatures
+KERNING_CHECKED = frozenset(ascii_letters + digits + ".,!?'\"-:;")
+
+# Every font we've measured in this process, keyed by (path, size), and
+# every chain, keyed by its FontChain.key
+_metrics = {}
+_metrics_lock = RLock()
+
+
+def get_metrics(font):
+    """Returns the shared metrics for a font or a FontChain, creating them if needed."""
+    key = getattr(font, "key", None) or (font.path, font.size)
+    with _metrics_lock:
+        if key not in _metrics:
+            _metrics[key] = ChainMetrics(font) if hasattr(font, "runs") else FontMetrics(font)
+        return _metrics[key]
+
+
+def forget_metrics(path):
+    """
+        Drops the metrics of the font file at path, at every size, and of
+        every chain, since any chain might have it as a fallback.
+    """
+    with _metrics_lock:
+        for key in [k for k in _metrics if k[0] in ("chain", path)]:
+            del _metrics[key]
+
+
+class FontMetrics(object):
+    """
+        Shared measurement cache for one font: a glyph advance table plus an
+        LRU of whole-word widths.
+
+        For fonts without kerning or ligatures a word's width is just the sum
+        of its glyph advances, so we build words up from the glyph table. If
+        the font does kern (we check every pair of common ASCII characters
+        when we're created), or a word has characters we didn't check, the
+        word gets measured as a whole instead. Either way, each word only ever
+        gets measured once.
+    """
+
+    def __init__(self, font, cache_size=WORD_CACHE_SIZE):
+        self.font = font
+        self.cache_size = cache_size
+        self._advances = {}
+        self._words = OrderedDict()
+        self._lock = RLock()
+        self.kerning = self._detect_kerning()
+        self.space_width = self.text_width(' ')
+
+    def _advance(self, char):
+        advance = self._advances.get(char)
+        if advance is None:
+            advance = self._advances[char] = self.font.getlength(char)
+        return advance
+
+    def _detect_kerning(self):
+        for first in KERNING_CHECKED:
+            for second in KERNING_CHECKED:
+                pair = first + second
+                if self.font.getlength(pair) != self._advance(first) + self._advance(second):
+                    return True
+        return False
+
+    def _measure(self, text):
+        if not self.kerning and KERNING_CHECKED.issuperset(text):
+            return sum(self._advance(char) for char in text)
+        return self.font.getlength(text)
+
+    def text_width(self, text):
+        with self._lock:
+            width = self._words.get(text)
+            if width is not None:
+                self._words.move_to_end(text)
+                return width
+            width = self._words[text] = self._measure(text)
+            if len(self._words) > self.cache_size:
+                self._words.popitem(last=False)
+            return width
+
+    def line_width(self, line):
+        """Width of a line of words, measured word by word like the wrapper does."""
+        words = line.split(' ')
+        return sum(self.text_width(word) for word in words) + self.space_width*(len(words)-1)
+
+
+class ChainMetrics(FontMetrics):
+    """
+        FontMetrics for a FontChain. Words are measured run by run, each run
+        with the metrics of the font it'll actually be drawn in.
+    """
+
+    def __init__(self, chain, cache_size=WORD_CACHE_SIZE):
+        self.chain = chain
+        super().__init__(chain.primary, cache_size)
+
+    def _measure(self, text):
+        if self.chain.primary_only(text):
+            return super()._measure(text)
+        return sum(get_metrics(self.chain.fonts[index]).text_width(run) for index, run in self.chain.runs(text))
+
+
+def _text_lines(text):
+    return [
+        ' '.join([w.strip() for w in l.split(' ') if w])
+        for l in text.split('\n')
+        if l
+    ]
+
+
+def _wrap_lines(text_lines, metrics, max_width):
+    wrapped_lines = []
+    buf = []
+    buf_width = 0
+
+    for line in text_lines:
+        for word in line.split(' '):
+            word_width = metrics.text_width(word)
+
+            expected_width = word_width if not buf else \
+                buf_width + metrics.space_width + word_width
+
+            if expected_width <= max_width:
+                # word fits in line
+                buf_width = expected_width
+                buf.append(word)
+            else:
+                # word doesn't fit in line
+                wrapped_lines.append(' '.join(buf))
+                buf = [word]
+                buf_width = word_width
+
+        if buf:
+            wrapped_lines.append(' '.join(buf))
+            buf = []
+            buf_width = 0
+
+    return '\n'.join(wrapped_lines)
+
+
+def wrap_many(texts, font, max_width):
+    """Wraps a batch of texts (e.g. a whole comic's worth) in one pass."""
+    metrics = get_metrics(font)
+    return [_wrap_lines(_text_lines(text), metrics, max_width) for text in texts]
 
 
 class TextWrapper(object):
@@ -14,57 +164,14 @@ class TextWrapper(object):
 
     def __init__(self, text, font, max_width):
         self.text = text
-        self.text_lines = [
-            ' '.join([w.strip() for w in l.split(' ') if w])
-            for l in text.split('\n')
-            if l
-        ]
+        self.text_lines = _text_lines(text)
         self.font = font
         self.max_width = max_width
-
-        self.draw = ImageDraw.Draw(
-            Image.new(
-                mode='RGB',
-                size=(100, 100)
-            )
-        )
-
-        self.space_width = self.draw.textsize(
-            text=' ',
-            font=self.font
-        )[0]
+        self.metrics = get_metrics(font)
+        self.space_width = self.metrics.space_width
 
     def get_text_width(self, text):
-        return self.draw.textsize(
-            text=text,
-            font=self.font
-        )[0]
+        return self.metrics.text_width(text)
 
     def wrapped_text(self):
-        wrapped_lines = []
-        buf = []
-        buf_width = 0
-
-        for line in self.text_lines:
-            for word in line.split(' '):
-                word_width = self.get_text_width(word)
-
-                expected_width = word_width if not buf else \
-                    buf_width + self.space_width + word_width
-
-                if expected_width <= self.max_width:
-                    # word fits in line
-                    buf_width = expected_width
-                    buf.append(word)
-                else:
-                    # word doesn't fit in line
-                    wrapped_lines.append(' '.join(buf))
-                    buf = [word]
-                    buf_width = word_width
-
-            if buf:
-                wrapped_lines.append(' '.join(buf))
-                buf = []
-                buf_width = 0
-
-        return '\n'.join(wrapped_lines)
+        return _wrap_lines(self.text_lines, self.metrics, self.max_width)
@@ -0,0 +1,105 @@
+import json
+import logging
+from math import ceil
+from time import perf_counter
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+log = logging.getLogger("red.weeedcog.timing")
+
+# The order stages show up in `weeed stats`
+STAGES = (
+    "fetch", "sanitize", "layout", "queue", "sprites", "draw", "encode", "render", "upload", "total"
+)
+# How many recent samples each guild keeps per stage
+WINDOW = 200
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return None
+    index = min(len(samples)-1, max(0, ceil(fraction*len(samples))-1))
+    return samples[index]
+
+
+class ComicTimer(object):
+    """
+        Collects named spans for one comic. Stages that run inside a render
+        worker come back as plain {stage: seconds} and get merged in with
+        add().
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self._start = perf_counter()
+
+    @contextmanager
+    def span(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, perf_counter()-start)
+
+    def add(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0)+seconds
+
+    def finish(self):
+        self.spans["total"] = perf_counter()-self._start
+        return self.spans
+
+
+class NullTimer(object):
+    """Stands in for ComicTimer when timing is turned off, doing nothing."""
+
+    spans = {}
+
+    @contextmanager
+    def span(self, stage):
+        yield
+
+    def add(self, stage, seconds):
+        pass
+
+    def finish(self):
+        return self.spans
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageStats(object):
+    """Rolling per-guild, per-stage samples for p50/p95/p99 reporting."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._samples = defaultdict(lambda: defaultdict(lambda: deque(maxlen=self.window)))
+
+    def timer(self, enabled):
+        return ComicTimer() if enabled else NULL_TIMER
+
+    def record(self, guild_id, spans, **details):
+        """Adds one comic's spans and emits them as a structured log event."""
+        for stage, seconds in spans.items():
+            self._samples[guild_id][stage].append(seconds)
+        log.info(
+            "comic timings %s",
+            json.dumps({"guild_id": guild_id, "spans": spans, **details}),
+            extra={"weeedcog_timings": {"guild_id": guild_id, "spans": spans, **details}}
+            )
+
+    def summary(self, guild_id):
+        """{stage: (samples, p50, p95, p99)} in seconds, for stages with samples."""
+        summary = {}
+        stages = self._samples.get(guild_id, {})
+        for stage in sorted(stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+            samples = sorted(stages[stage])
+            summary[stage] = (
+                len(samples),
+                percentile(samples, 0.50),
+                percentile(samples, 0.95),
+                percentile(samples, 0.99)
+                )
+        return summary
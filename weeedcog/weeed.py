@@ -1,14 +1,41 @@
-import re
+import logging
 from io import BytesIO
-from os import listdir
-from typing import List
-from random import shuffle
+from asyncio import get_running_loop, sleep
+from time import perf_counter
+from typing import List, Optional
 import discord
 from redbot.core import commands, Config, checks
-from redbot.core.data_manager import bundled_data_path
+from redbot.core.utils.chat_formatting import pagify
+from redbot.core.data_manager import bundled_data_path, cog_data_path
 from redbot.core.bot import Red
-from PIL import Image, ImageOps, ImageDraw, ImageFont
-from .textwrapper import TextWrapper
+from .assets import get_asset_cache
+from .layout import TEXT_WIDTH, layout_comic, messages_to_comicdata
+from .renderer import ComicRenderer, EXECUTOR_MODES, RENDER_VERSION
+from .compositor import COMPOSITORS, HAVE_NUMPY
+from .encoder import ENCODING_MODES
+from .backgrounds import BACKGROUND_MODES, pick_backgrounds
+from .manifest import AssetManifest, POLL_SECONDS
+from .characters import cast_characters
+from .settings import GuildSettings
+from .sanitizer import Sanitizer
+from .comiccache import ComicCache, comic_key
+from .timing import StageStats
+from .scheduler import QueueFull, RenderScheduler, DEFAULT_CONCURRENCY, DEFAULT_GUILD_DEPTH
+from .history import (
+    CachedMessage, MessageBuffer, take_conversation, CONVERSATION_WINDOW,
+    DEFAULT_CHANNEL_SIZE, DEFAULT_MAX_CHANNELS, DEFAULT_IDLE_SECONDS
+)
+
+
+log = logging.getLogger("red.weeedcog")
+
+# Size-budgeted encoding keeps long comics under the upload limit, and
+# anything too tall to hold as one canvas gets streamed out a panel at a
+# time (see render_comic), so memory doesn't cap this anymore
+MAX_MESSAGES = 200
+# Every Discord snowflake is a timestamp shifted left 22 bits, so nothing
+# this big is a message count
+SNOWFLAKE_MIN = 1 << 22
 
 
 class WeeedBot(commands.Cog):
@@ -25,14 +52,125 @@ class WeeedBot(commands.Cog):
         self.deafult_config_guild = {
             "max_messages": 10,
             "background_image": 'beach-paradise-beach-desktop.jpg',
+            "background_mode": "fixed",
             "comic_text": None,
-            "font": 'ComicBD.ttf'
+            # str(user ID) -> character filename, so people always show up
+            # as the same character
+            "characters": {},
+            "font": 'ComicBD.ttf',
+            "encoding": "auto"
             }
         self.config.register_guild(**self.deafult_config_guild)
-        # Panels are 450px wide, so we make the text 300 wide to keep the
-        # noticable offset of the left and right text blocks
+        # Render settings are bot-wide since there's only one worker pool
+        self.default_config_global = {
+            "render_workers": 2,
+            "render_executor": "process",
+            # Threads each render draws panels with
+            "panel_threads": 1,
+            # "pil", or "numpy" if it's installed
+            "compositor": "pil",
+            # Recent message buffer limits
+            "buffer_channel_size": DEFAULT_CHANNEL_SIZE,
+            "buffer_max_channels": DEFAULT_MAX_CHANNELS,
+            "buffer_idle_minutes": DEFAULT_IDLE_SECONDS // 60,
+            # How many comics render at once, and how many each guild can
+            # have waiting
+            "render_concurrency": DEFAULT_CONCURRENCY,
+            "render_queue_depth": DEFAULT_GUILD_DEPTH,
+            # How much disk rendered comics can take up
+            "comic_cache_mb": 256,
+            # Whether to time each stage of every comic for `weeed stats`
+            "timing_enabled": False
+            }
+        self.config.register_global(**self.default_config_global)
         # This is our global text block width
-        self.text_width = 300
+        self.text_width = TEXT_WIDTH
+        # The asset cache and the renderer (which owns the worker pool that
+        # comics get drawn in) both need the data path, so they're set up
+        # once the cog is loaded.
+        self.assets = None
+        self.renderer = None
+        self.comic_cache = None
+        # Index of the bundled assets, so nothing has to listdir() them
+        self.manifest = None
+        self._manifest_task = None
+        # guild ID -> GuildSettings, filled in the first time a guild needs it
+        # and kept up to date by the wset commands
+        self._guild_settings = {}
+        # guild ID -> the guild's saved characters, same deal
+        self._guild_characters = {}
+        # Sanitized message text, cached by message ID
+        self.sanitizer = Sanitizer()
+        # Recent messages per channel, so comics can skip ctx.history()
+        self.history = MessageBuffer()
+        # Per-stage comic timings for `weeed stats`
+        self.stats = StageStats()
+        self.timing_enabled = False
+        # Every render goes through here so they can't all run at once
+        self.scheduler = RenderScheduler()
+
+    async def cog_load(self):
+        workers = await self.config.render_workers()
+        mode = await self.config.render_executor()
+        compositor = await self.config.compositor()
+        if compositor == "numpy" and not HAVE_NUMPY:
+            print("[WEEEDCOG] compositor is set to numpy but it isn't installed, using pil")
+            compositor = "pil"
+        self.timing_enabled = await self.config.timing_enabled()
+        self.scheduler.configure(
+            concurrency=await self.config.render_concurrency(),
+            guild_depth=await self.config.render_queue_depth()
+            )
+        self.history.configure(
+            channel_size=await self.config.buffer_channel_size(),
+            max_channels=await self.config.buffer_max_channels(),
+            idle_seconds=(await self.config.buffer_idle_minutes())*60
+            )
+        # We're reading every guild's settings anyway, so fill the snapshot
+        # cache while we're at it
+        guilds = await self.config.all_guilds()
+        for guild_id, data in guilds.items():
+            self._guild_settings[guild_id] = GuildSettings.from_config(data)
+            self._guild_characters[guild_id] = dict(data["characters"])
+        # Indexing and warming decode a pile of images and the comic cache
+        # lists its folder, so keep all of it off the event loop
+        loop = get_running_loop()
+        self.manifest = await loop.run_in_executor(None, AssetManifest, self.datapath)
+        backgrounds = set(g.background_image for g in self._guild_settings.values())
+        backgrounds.add(self.deafult_config_guild["background_image"])
+        # A guild can still have a background saved that's since been
+        # deleted, and there's nothing to warm for that
+        backgrounds = {b for b in backgrounds if self.manifest.has("background", b)}
+        # Guilds with random backgrounds could end up using any of them
+        if any(g.background_mode != "fixed" for g in self._guild_settings.values()):
+            backgrounds = None
+        self.assets = get_asset_cache(self.datapath)
+        self.renderer = ComicRenderer(
+            self.datapath, workers=workers, mode=mode,
+            warm_backgrounds=backgrounds, sprite_path=self.sprite_path,
+            panel_threads=await self.config.panel_threads(),
+            compositor=compositor
+            )
+        await loop.run_in_executor(None, lambda: self.assets.warm(backgrounds=backgrounds))
+        cache_bytes = (await self.config.comic_cache_mb())*1024*1024
+        self.comic_cache = await loop.run_in_executor(None, ComicCache, self.comic_cache_path, cache_bytes)
+        self._manifest_task = loop.create_task(self._watch_assets())
+
+    async def cog_unload(self):
+        if self._manifest_task:
+            self._manifest_task.cancel()
+        if self.renderer:
+            self.renderer.shutdown()
+
+    async def _watch_assets(self):
+        """Picks up assets being added, swapped out or removed while we're running."""
+        loop = get_running_loop()
+        while True:
+            await sleep(POLL_SECONDS)
+            changed = await loop.run_in_executor(None, self.manifest.refresh)
+            for kind, name in changed:
+                print(f"[WEEEDCOG] {kind} {name} changed on disk, reloading it")
+                self.renderer.invalidate(kind, name)
 
     # self.datapath is a property here since the data path doesn't exist
     # yet when we create the cog's instance
@@ -43,9 +181,80 @@ class WeeedBot(commands.Cog):
         """Returns the path to the bundled data folder."""
         return str(bundled_data_path(self))
 
+    @property
+    def sprite_path(self):
+        """Returns the path scaled character thumbnails get saved to."""
+        return str(cog_data_path(self) / "sprites")
+
+    @property
+    def comic_cache_path(self):
+        """Returns the path rendered comics get cached in."""
+        return str(cog_data_path(self) / "comics")
+
     def _get_font(self, font):
-        font_path = f"{self.datapath}/font/{font}"
-        return ImageFont.truetype(font_path, size=15)
+        return self.assets.font_chain(font)
+
+    async def _get_settings(self, guild) -> GuildSettings:
+        """Returns the guild's settings snapshot, reading Config on a miss."""
+        settings = self._guild_settings.get(guild.id)
+        if settings is None:
+            settings = GuildSettings.from_config(await self.config.guild(guild).all())
+            self._guild_settings[guild.id] = settings
+        return settings
+
+    async def _set_setting(self, guild, key, value) -> GuildSettings:
+        """Writes one setting through to Config and updates the snapshot."""
+        await self.config.guild(guild).set_raw(key, value=value)
+        settings = (await self._get_settings(guild))._replace(**{key: value})
+        self._guild_settings[guild.id] = settings
+        return settings
+
+    async def _get_characters(self, guild) -> dict:
+        """Returns the guild's saved {str(user ID): character}, reading Config on a miss."""
+        characters = self._guild_characters.get(guild.id)
+        if characters is None:
+            characters = dict(await self.config.guild(guild).characters())
+            self._guild_characters[guild.id] = characters
+        return characters
+
+    async def _save_characters(self, guild, changes):
+        """Saves {str(user ID): character, or None to forget them} to Config and the cache."""
+        characters = await self._get_characters(guild)
+        async with self.config.guild(guild).characters() as saved:
+            for user_id, char in changes.items():
+                if char is None:
+                    saved.pop(user_id, None)
+                    characters.pop(user_id, None)
+                else:
+                    saved[user_id] = characters[user_id] = char
+
+    # These listeners keep the recent message buffer in sync with the
+    # channels we can see
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is None:
+            return
+        self.history.add(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        if "content" in payload.data:
+            edited_at = discord.utils.parse_time(payload.data.get("edited_timestamp"))
+            self.history.edit(payload.channel_id, payload.message_id, payload.data["content"], edited_at)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.history.delete(payload.channel_id, {payload.message_id})
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        self.history.delete(payload.channel_id, payload.message_ids)
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        # We can't tell what we missed while we were gone, so the buffers
+        # can't be trusted to be gapless anymore
+        self.history.clear()
 
     # This decorator defines the cog's command group, basically our own
     # namespace where we can make all our commands common words without
@@ -61,38 +270,72 @@ class WeeedBot(commands.Cog):
         """Configure various WeeedCog settings."""
         pass
 
+    @weeed.command()
+    async def character(self, ctx: commands.Context, name: str = None):
+        """Shows or picks the character you're drawn as, or "list", or "reset" to get a new one."""
+        author_key = str(ctx.author.id)
+        if not name:
+            current = (await self._get_characters(ctx.guild)).get(author_key)
+            if current:
+                await ctx.send(f"You're drawn as `{current}` in this guild.")
+            else:
+                await ctx.send("You'll get a character the first time you show up in a comic.")
+        elif name == "list":
+            for page in pagify(", ".join(self.manifest.names("char")), delims=[", "]):
+                await ctx.send(page)
+        elif name == "reset":
+            await self._save_characters(ctx.guild, {author_key: None})
+            await ctx.send("You'll get a new character in your next comic.")
+        elif self.manifest.has("char", name):
+            await self._save_characters(ctx.guild, {author_key: name})
+            await ctx.send(f"You're now drawn as `{name}` in this guild.")
+        else:
+            await ctx.send(f"Couldn't find a character called '{name}'")
+
     @wset.command()
     async def background_image(self, ctx, filename: str = None):
         """Changes the background to use for the comics, or "list"."""
         if not filename:
-            current_bg = await self.config.guild(ctx.guild).background_image()
+            current_bg = (await self._get_settings(ctx.guild)).background_image
             await ctx.send(f"background_image is currently `{current_bg}` for this guild.")
         elif filename == "list":
-            files = listdir(f"{self.datapath}/background")
-            await ctx.send(f"backgrounds: {files}")
+            await ctx.send(f"backgrounds: {list(self.manifest.names('background'))}")
         else:
-            files = listdir(f"{self.datapath}/background")
-            if filename in files:
-                await self.config.guild(ctx.guild).background_image.set(filename)
-                new_bg = await self.config.guild(ctx.guild).background_image()
+            if self.manifest.has("background", filename):
+                old_bg = (await self._get_settings(ctx.guild)).background_image
+                new_bg = (await self._set_setting(ctx.guild, "background_image", filename)).background_image
+                if old_bg != new_bg:
+                    self.renderer.invalidate("background", old_bg)
                 await ctx.send(f"New background_image for this guild is {new_bg}")
             else:
                 await ctx.send(f"Couldn't find a background file called '{filename}'")
 
+    @wset.command()
+    async def background_mode(self, ctx, mode: str = None):
+        """ "fixed" (always background_image), "random_comic", or "random_panel" """
+        if not mode:
+            current_mode = (await self._get_settings(ctx.guild)).background_mode
+            await ctx.send(f"background_mode is currently `{current_mode}` for this guild.")
+        elif mode not in BACKGROUND_MODES:
+            await ctx.send(f"background_mode must be one of {list(BACKGROUND_MODES)}")
+        else:
+            new_mode = (await self._set_setting(ctx.guild, "background_mode", mode)).background_mode
+            await ctx.send(f"background_mode for this guild is now set to {new_mode}")
+
     @wset.command()
     async def font(self, ctx, filename: str = None):
         """Changes the font to use for the comics, or "list"."""
         if not filename:
-            current_font = await self.config.guild(ctx.guild).font()
+            current_font = (await self._get_settings(ctx.guild)).font
             await ctx.send(f"font is currently `{current_font}` for this guild.")
         elif filename == "list":
-            files = listdir(f"{self.datapath}/font")
-            await ctx.send(f"fonts: {files}")
+            await ctx.send(f"fonts: {list(self.manifest.names('font'))}")
         else:
-            files = listdir(f"{self.datapath}/font")
-            if filename in files:
-                await self.config.guild(ctx.guild).font.set(filename)
-                new_font = await self.config.guild(ctx.guild).font()
+            if self.manifest.has("font", filename):
+                old_font = (await self._get_settings(ctx.guild)).font
+                new_font = (await self._set_setting(ctx.guild, "font", filename)).font
+                if old_font != new_font:
+                    self.renderer.invalidate("font", old_font)
                 await ctx.send(f"New font for this guild is {new_font}")
             else:
                 await ctx.send(f"Couldn't find a font file called '{filename}'")
@@ -101,140 +344,240 @@ class WeeedBot(commands.Cog):
     async def max_messages(self, ctx: commands.Context, max: int = None):
         """ The max number of messages you can put in a comic """
         if not max:
-            current_max = await self.config.guild(ctx.guild).max_messages()
+            current_max = (await self._get_settings(ctx.guild)).max_messages
             await ctx.send(f"max_messages is currently {current_max} for this guild.")
         elif max < 1:
             await ctx.send("That number is too small.")
-        elif max > 80:
-            await ctx.send("Setting this higher than 80 will result in files too big to post.")
-        elif max not in range(1, 81):
+        elif max > MAX_MESSAGES:
+            await ctx.send(f"Setting this higher than {MAX_MESSAGES} will result in files too big to post.")
+        elif max not in range(1, MAX_MESSAGES+1):
             await ctx.send("Invalid value for max_messages")
         else:
-            await self.config.guild(ctx.guild).max_messages.set(max)
-            new_max = await self.config.guild(ctx.guild).max_messages()
+            new_max = (await self._set_setting(ctx.guild, "max_messages", max)).max_messages
             await ctx.send(f"max_messages for this guild is now set to {new_max}")
 
+    @wset.command()
+    async def encoding(self, ctx: commands.Context, mode: str = None):
+        """ How comics get encoded: "png", "lossless", or "auto" (smallest that fits) """
+        if not mode:
+            current_mode = (await self._get_settings(ctx.guild)).encoding
+            await ctx.send(f"encoding is currently `{current_mode}` for this guild.")
+        elif mode not in ENCODING_MODES:
+            await ctx.send(f"encoding must be one of {list(ENCODING_MODES)}")
+        else:
+            new_mode = (await self._set_setting(ctx.guild, "encoding", mode)).encoding
+            await ctx.send(f"encoding for this guild is now set to {new_mode}")
+
+    @wset.command()
+    @checks.is_owner()
+    async def render_workers(self, ctx: commands.Context, workers: int = None, mode: str = None):
+        """ Number of workers used to render comics, and optionally "process" or "thread" """
+        if not workers:
+            await ctx.send(f"render_workers is currently {self.renderer.workers} ({self.renderer.mode}).")
+        elif workers < 1:
+            await ctx.send("That number is too small.")
+        elif mode and mode not in EXECUTOR_MODES:
+            await ctx.send(f"Executor mode must be one of {EXECUTOR_MODES}")
+        else:
+            await self.config.render_workers.set(workers)
+            if mode:
+                await self.config.render_executor.set(mode)
+            self.renderer.configure(workers=workers, mode=mode)
+            await ctx.send(f"render_workers is now set to {self.renderer.workers} ({self.renderer.mode})")
+
+    @wset.command()
+    @checks.is_owner()
+    async def panel_threads(self, ctx: commands.Context, threads: int = None):
+        """ Number of threads each comic's panels are drawn with """
+        if not threads:
+            await ctx.send(f"panel_threads is currently {self.renderer.panel_threads}.")
+        elif threads < 1:
+            await ctx.send("That number is too small.")
+        else:
+            await self.config.panel_threads.set(threads)
+            self.renderer.panel_threads = threads
+            await ctx.send(f"panel_threads is now set to {threads}")
+
+    @wset.command()
+    @checks.is_owner()
+    async def compositor(self, ctx: commands.Context, name: str = None):
+        """ How whole comics get put together: "pil", or "numpy" if it's installed """
+        if not name:
+            await ctx.send(f"compositor is currently `{self.renderer.compositor}`.")
+        elif name not in COMPOSITORS:
+            await ctx.send(f"compositor must be one of {list(COMPOSITORS)}")
+        elif name == "numpy" and not HAVE_NUMPY:
+            await ctx.send("NumPy isn't installed, so the numpy compositor isn't available.")
+        else:
+            await self.config.compositor.set(name)
+            self.renderer.compositor = name
+            await ctx.send(f"compositor is now set to {name}")
+
+    @wset.command()
+    @checks.is_owner()
+    async def buffer(self, ctx: commands.Context, channel_size: int = None,
+                     max_channels: int = None, idle_minutes: int = None):
+        """ Limits for the recent message buffer: messages per channel, channels, and idle minutes """
+        if not channel_size:
+            await ctx.send(
+                f"buffer is currently {self.history.channel_size} messages per channel, "
+                f"{self.history.max_channels} channels, dropped after {self.history.idle_seconds // 60} idle minutes."
+                )
+        elif min(x for x in (channel_size, max_channels, idle_minutes) if x is not None) < 1:
+            await ctx.send("That number is too small.")
+        else:
+            await self.config.buffer_channel_size.set(channel_size)
+            if max_channels:
+                await self.config.buffer_max_channels.set(max_channels)
+            if idle_minutes:
+                await self.config.buffer_idle_minutes.set(idle_minutes)
+            self.history.configure(
+                channel_size=channel_size,
+                max_channels=max_channels,
+                idle_seconds=idle_minutes*60 if idle_minutes else None
+                )
+            await ctx.send(
+                f"buffer is now {self.history.channel_size} messages per channel, "
+                f"{self.history.max_channels} channels, dropped after {self.history.idle_seconds // 60} idle minutes."
+                )
+
+    @wset.command()
+    @checks.is_owner()
+    async def render_queue(self, ctx: commands.Context, concurrency: int = None, guild_depth: int = None):
+        """ How many comics render at once, and optionally how many each guild can have waiting """
+        if not concurrency:
+            await ctx.send(
+                f"render_queue is currently {self.scheduler.concurrency} at once, "
+                f"{self.scheduler.guild_depth} waiting per guild."
+                )
+        elif min(x for x in (concurrency, guild_depth) if x is not None) < 1:
+            await ctx.send("That number is too small.")
+        else:
+            await self.config.render_concurrency.set(concurrency)
+            if guild_depth:
+                await self.config.render_queue_depth.set(guild_depth)
+            self.scheduler.configure(concurrency=concurrency, guild_depth=guild_depth)
+            await ctx.send(
+                f"render_queue is now {self.scheduler.concurrency} at once, "
+                f"{self.scheduler.guild_depth} waiting per guild."
+                )
+
+    @wset.command()
+    @checks.is_owner()
+    async def comic_cache(self, ctx: commands.Context, megabytes: int = None):
+        """ How many megabytes of rendered comics to keep on disk """
+        if megabytes is None:
+            await ctx.send(
+                f"comic_cache is currently {self.comic_cache.max_bytes // (1024*1024)}MB, "
+                f"{self.comic_cache.current_bytes / (1024*1024):.1f}MB used."
+                )
+        elif megabytes < 0:
+            await ctx.send("That number is too small.")
+        else:
+            await self.config.comic_cache_mb.set(megabytes)
+            # Shrinking it deletes files, so keep that off the event loop
+            loop = get_running_loop()
+            await loop.run_in_executor(None, self.comic_cache.resize, megabytes*1024*1024)
+            await ctx.send(f"comic_cache is now set to {megabytes}MB.")
+
+    @wset.command()
+    @checks.is_owner()
+    async def timing(self, ctx: commands.Context, enabled: bool = None):
+        """ Whether to time every stage of every comic, for `weeed stats` """
+        if enabled is None:
+            await ctx.send(f"timing is currently {'on' if self.timing_enabled else 'off'}.")
+        else:
+            await self.config.timing_enabled.set(enabled)
+            self.timing_enabled = enabled
+            await ctx.send(f"timing is now {'on' if enabled else 'off'}.")
+
     @wset.command()
     async def comic_text(self, ctx: commands.Context, *, text: str = None):
         """ Optional text element to accompany the post e.g. "Whoa, here's a comic:", or 'none' """
         if not text:
-            current_text = await self.config.guild(ctx.guild).comic_text()
+            current_text = (await self._get_settings(ctx.guild)).comic_text
             await ctx.send(f"comic_text is currently {current_text} for this guild.")
         elif text.lower() == "none":
-            await self.config.guild(ctx.guild).comic_text.set(None)
+            await self._set_setting(ctx.guild, "comic_text", None)
             await ctx.send("comic_text has been removed for this guild.")
         else:
-            await self.config.guild(ctx.guild).comic_text.set(text)
-            new_text = await self.config.guild(ctx.guild).comic_text()
+            new_text = (await self._set_setting(ctx.guild, "comic_text", text)).comic_text
             await ctx.send(f"comic_text is now set to {new_text}")
 
-    async def _get_rendered_text(self, text, font, width):
-        wrapper = TextWrapper(text, font, width)
-        return wrapper.wrapped_text()
-
-    @staticmethod
-    def _sanitize_usernames(guild, text):
-        regex = re.compile(r"(?:<@!?)([0-9]+)(?:>)")
-        result = re.sub(
-                    regex,
-                    lambda m: guild.get_member(int(m.group(1))).display_name,
-                    text)
-        return result
-
-    @staticmethod
-    def _sanitize_channelnames(guild, text):
-        regex = re.compile(r"(?:<#)([0-9]+)(?:>)")
-        result = re.sub(
-                    regex,
-                    lambda m: f"#{guild.get_channel(int(m.group(1))).name}",
-                    text
-                    )
-        return result
-
-    @staticmethod
-    def _sanitize_emojinames(text):
-        regex = re.compile(r"(?:<a?)(\:[0-9a-zA-Z]+\:)(?:[0-9]+>)")
-        result = re.sub(
-                    regex,
-                    lambda m: m.group(1),
-                    text
-                    )
-        return result
-
-    # This takes a list of discord messages and converts them to a dict that we
-    # can easily use to generate the comic.
-    async def _messages_to_comicdata(self, messages: List[discord.Message]):
-        """Convert list of discord messages to comic data."""
-        comic = []
-        panel = []
-        # Using enumerate so we can carry an index for lookahead, lookbehind
-        for index, action in enumerate(messages):
-            # The very first message always goes in the same spot
-            # TODO: sanitize these messages as we go, replacing user snowflakes
-            # with user names, emoji snowflakes with :emojiname:, etc. etc.
-            prev_text = self._sanitize_usernames(action.guild, messages[index-1].content)
-            prev_text = self._sanitize_channelnames(action.guild, prev_text)
-            prev_text = self._sanitize_emojinames(prev_text)
-            this_text = self._sanitize_usernames(action.guild, action.content)
-            this_text = self._sanitize_channelnames(action.guild, this_text)
-            this_text = self._sanitize_emojinames(this_text)
-            # TODO: build a frankenfont that has all codepoints that Comic Sans
-            # doesn't cover replaced with Noto Emoji font glyphs for better
-            # rendering of unicode emojis
-            if len(panel) == 1:  # We're looking at the "right" side
-                guild_font = await self.config.guild(action.guild).font()
-                font = self._get_font(guild_font)
-                prev_text_rendered = await self._get_rendered_text(prev_text, font, self.text_width)
-                # Blank panel if last author and this one are the same
-                # Blank panel if last message height is over 3 lines tall
-                if action.author == messages[index-1].author or len(prev_text_rendered.split('\n')) > 3:
-                    # So in this case we want to only have one action
-                    # in the panel instead of two because of either
-                    # a monologue or a big text block
-                    # We probably want to change 'char' to the user's ID
-                    # when we switch to not pulling char image names
-                    panel.append({'char': None, 'text': None})
-                    comic.append(panel)
-                    panel = []
-                    panel.append({
-                        'text': this_text,
-                        'id': action.author.id
-                        })
-                    continue
-            panel.append({
-                'text': this_text,
-                'id': action.author.id
-                })
-            if len(panel) == 2:
-                comic.append(panel)
-                panel = []
-        # Now we check for any stragglers and append them.
-        if len(panel) > 0:
-            comic.append(panel)
+    # This takes a list of messages and converts them to a dict that we
+    # can easily use to generate the comic, then works out where everything
+    # goes. It's all CPU work (and maybe loading a font), so it gets run in
+    # the executor instead of on the event loop.
+    def _layout_comic(self, guild, messages: List[CachedMessage], font_name, timer):
+        """Convert list of messages to comic data and lay it out."""
+        font = self._get_font(font_name)
+        # Sanitize every message exactly once, replacing user snowflakes
+        # with user names, emoji snowflakes with :emojiname:, etc. etc.
+        # font is a fallback chain, so anything Comic Sans doesn't cover
+        # gets drawn in whichever bundled font does. Emoji still need an
+        # emoji font dropped into data/font before they stop being tofu.
+        with timer.span("sanitize"):
+            comic = messages_to_comicdata(guild, messages, font, self.sanitizer, self.text_width)
         # Our data is now ready. Time to build an image!
         print(f"[WEEEDCOG] Comic data generated! Data follows:\n{comic}")
-        return comic
+        with timer.span("layout"):
+            layout = layout_comic(comic, font)
+        return comic, layout
+
+    async def _conversation(self, ctx, anchor_msg, anchor_included, max_messages, timer):
+        """The messages of the conversation leading up to anchor_msg, oldest first."""
+        since = anchor_msg.created_at-CONVERSATION_WINDOW
+        # When the anchor was picked by ID it's part of the comic, so it
+        # takes up a slot and the gap right before it counts too
+        limit = max_messages-1 if anchor_included else max_messages
+        newer = anchor_msg.created_at if anchor_included else None
+        # The buffer already knows where conversations start, so this is
+        # usually just a walk back over the last few messages...
+        messages = self.history.conversation(ctx.channel.id, anchor_msg.id, since, limit, newer)
+        if messages is not None:
+            return messages
+        # ...otherwise we only ask Discord for what could possibly be in the
+        # window, and find the gap ourselves
+        with timer.span("fetch"):
+            fetched = [
+                m async for m in ctx.history(before=discord.Object(id=anchor_msg.id),
+                                             after=since,
+                                             limit=limit,
+                                             oldest_first=False)
+                ]
+        messages, _ = take_conversation((CachedMessage.from_message(m) for m in fetched), since, limit, newer)
+        return messages
 
     # Defines our main 'comic' command
-    # Takes one int for comic length and another optional int to let us pick
-    # what message should be the last
-    # TODO: make the count var optional, and if it's not defined the comic
-    # should be the last N messages where N is the number of messages in the
-    # past 120 seconds or until there's a gap greater than 20 seconds between
-    # any message and the one prior
+    # Takes one optional int for comic length and another optional int to let
+    # us pick what message should be the last. Without a count, the comic is
+    # the last N messages where N is the number of messages in the past 120
+    # seconds or until there's a gap greater than 20 seconds between any
+    # message and the one prior
     @weeed.command()
-    async def comic(self, ctx: commands.Context, count: int, message_id: int = None):
+    async def comic(self, ctx: commands.Context, count: Optional[int] = None, message_id: int = None):
         """
             Generates a comic using the last specified number of messages. Can optionally send a message ID as well
             and it will grab that message and the specified number prior to it. If "comic_text" option is set,
             the comic will be accompanied by that configured text.
+
+            Without a number, the comic is the current conversation: everything from the last two minutes, up to
+            the first time nobody said anything for 20 seconds (and no more than max_messages). Give just a
+            message ID to get the conversation leading up to that message.
         """
-        server_cfg = self.config.guild(ctx.guild)
-        max_messages = await server_cfg.max_messages()
-        background_image = await server_cfg.background_image()
-        comic_text = await server_cfg.comic_text()
+        # A lone message ID lands in count, since that comes first
+        if count is not None and count >= SNOWFLAKE_MIN and message_id is None:
+            count, message_id = None, count
+        # Every setting this comic needs, read once up front
+        settings = await self._get_settings(ctx.guild)
+        max_messages = settings.max_messages
+        # Does nothing unless timing is turned on
+        timer = self.stats.timer(self.timing_enabled)
 
-        if count > max_messages:
+        if count is None:
+            # No count means we work it out from the conversation below
+            pass
+        elif count > max_messages:
             await ctx.send("Whoa there, shitlord! You expect me to parse _All That Shit_ by _you_?")
             return
         # Yeah yeah ok so -1 is technically an integer... Let's handle that
@@ -248,163 +591,177 @@ class WeeedBot(commands.Cog):
         # TODO: also make the messages either configurable, i18n, or both
         # So if we're passed a message ID as a second argument...
         if message_id:
-            # ...see if we can pull a valid message object...
-            try:
-                anchor_msg = await ctx.fetch_message(message_id)
-            # ...and if we can't, throw an error
-            # TODO: expand this to actually catch the exceptions this can throw
-            except (discord.NotFound, discord.Forbidden, discord.HTTPException) as error:
-                await ctx.send(f"Unable to find a message with that ID...{error}")
-                return
-            # So the except returns, which means this happens only if we
-            # were successful. We subtract 1 from the count so that we can
-            # later make up for the offset inherent to ctx.history()
-            finally:
+            # ...check whether we've already got it buffered...
+            anchor_msg = self.history.get(ctx.channel.id, message_id)
+            # ...otherwise see if we can pull a valid message object...
+            if anchor_msg is None:
+                try:
+                    with timer.span("fetch"):
+                        anchor_msg = CachedMessage.from_message(await ctx.fetch_message(message_id))
+                # ...and if we can't, throw an error
+                # TODO: expand this to actually catch the exceptions this can throw
+                except (discord.NotFound, discord.Forbidden, discord.HTTPException) as error:
+                    await ctx.send(f"Unable to find a message with that ID...{error}")
+                    return
+            # We subtract 1 from the count so that we can later make up for
+            # the anchor message itself being part of the comic
+            if count is not None:
                 count = count-1
         # By default if we're not given a message, we use the message that
         # called the command as our "anchor"
         else:
-            anchor_msg = ctx.message
-        # Get the specified number of messages using ctx.history()
-        messages = await ctx.history(before=anchor_msg,
-                                     limit=count,
-                                     oldest_first=False).flatten()
-        messages.reverse()
+            anchor_msg = CachedMessage.from_message(ctx.message)
+        if count is None:
+            messages = await self._conversation(ctx, anchor_msg, bool(message_id), max_messages, timer)
+            if not messages and not message_id:
+                await ctx.send("Nobody's said anything in the last two minutes. Give me a number instead!")
+                return
+        else:
+            # Serve the messages from the buffer if it reaches back far enough...
+            messages = self.history.before(ctx.channel.id, anchor_msg.id, count)
+        # ...and get the specified number of messages using ctx.history()
+        # if it doesn't
+        if messages is None:
+            with timer.span("fetch"):
+                fetched = [
+                    m async for m in ctx.history(before=discord.Object(id=anchor_msg.id),
+                                                 limit=count,
+                                                 oldest_first=False)
+                    ]
+            fetched.reverse()
+            messages = [CachedMessage.from_message(m) for m in fetched]
         # Again, if given a message ID, we need to get the history but also
-        # add the message with the ID that was passed and, since we're using
-        # reverse=True we append (otherwise we'd prepend)
+        # add the message with the ID that was passed and, since the list is
+        # oldest first we append (otherwise we'd prepend)
         if message_id:
             messages.append(anchor_msg)
 
-        comic = await self._messages_to_comicdata(messages)
-        # These have been the defaults since the dawn of time. Do we ever want
-        # to make them configurable? That would require some other changes too.
-        panel_width = 450
-        panel_height = 300
-        # Create a canvas for us to put our stuff in
-        # TODO: look into the bug where over 100 messages breaks this somehow?
-        # No issue filed for the above todo yet
-        canvas_height = panel_height*len(comic)
-        canvas = Image.new("RGBA", (panel_width, canvas_height))
-        # canvas_bytes is the in-memory image since we can't use the Image
-        # object directly as our attached file.
-        canvas_bytes = BytesIO()
-        # Again, since the dawn of time this is the only background the comic
-        # has ever used, but prescriptivism is shit so...
-        # TODO: make this configurable per-server. One option is a specific
-        # background with the default being the standard one, and the other
-        # option should be to pick a random background and use it for every
-        # panel, and maybe even one last option of a random background per panel
-        background = Image.open(f"{self.datapath}/background/{background_image}").convert("RGBA")
-        # Create our Draw object
-        draw = ImageDraw.Draw(canvas)
-        # This is the top and sides margin size for text and characters
-        # TODO: make this configurable per-server and take into account how
-        # changing this changes text and char rendering
-        text_buffer = 10
-        # Here's where we load our characters. The stuff way above where we
-        # pick a bunch of chars for each unique author should probably just be
-        # a simple list of unique IDs and we'll do the rest here instead.
-        # TODO: refactor per previous comment
-        # Now get a list of authors of messages that will be in the comic
-        # Specifically we are getting _unique_ authors, thus the list(set())
-        author_ids = list(set([m.author.id for m in messages]))
-        char_img_map = {}
-        all_chars = listdir(f"{self.datapath}/char")
-        shuffle(all_chars)
-        for inc, id in enumerate(author_ids):
-            char_img_map[id] = Image.open(f"{self.datapath}/char/{all_chars[inc]}")
-        # I think instead of iterating against a range like this, we should
-        # probably iterate against the comic object directly?
-        # This is where things get messy tbh, lots of possible refactoring and
-        # optimizing inside this for-loop
-        for panel_count in range(0, len(comic)):
-            # Paste in our background first
-            canvas.paste(background, (0, (panel_height*panel_count)))
-            # Calculate the bottom edge for various reasons
-            bottom_edge = panel_height*(panel_count+1)
-            # Next we need to draw text...
-            # We start by wrapping the text using our helper class
-            # TextWrapper, just to be clear, calculates the length of rendered
-            # text and wraps any words that would be wider than a given width
-            guild_font = await self.config.guild(ctx.guild).font()
-            font = self._get_font(guild_font)
-            left_text = await self._get_rendered_text(
-                                    comic[panel_count][0]['text'],
-                                    font,
-                                    self.text_width
-                                    )
-            # Now we find out how tall the left side text is so we can scale
-            # the chars properly beneath it.
-            (_, left_text_height) = draw.multiline_textsize(left_text, font=font)
-            # We also need to calculate the right side text height because we
-            # have the two chars scaled to be as tall as the space left beneath
-            # both of the rendered text blocks
-            # Here we check if there's going to be right side text at all
-            if len(comic[panel_count]) == 1 or not comic[panel_count][1]['text']:
-                right_text_height = 0
-            else:
-                right_text = await self._get_rendered_text(
-                    comic[panel_count][1]['text'],
-                    font,
-                    self.text_width
+        # Here's where we pick our characters. We get a list of the _unique_
+        # authors of messages that will be in the comic, in the order they
+        # first speak, and look up the character each of them is drawn as.
+        # Anyone who hasn't been in a comic here before gets one assigned
+        # and saved, so they look the same next time.
+        author_ids = list(dict.fromkeys(m.author_id for m in messages))
+        characters, assigned = cast_characters(
+            ctx.guild.id, author_ids, await self._get_characters(ctx.guild), self.manifest.names("char")
+            )
+        if assigned:
+            await self._save_characters(ctx.guild, assigned)
+        # With a random background mode, what there is to pick from matters
+        # as much as what the guild's background_image is
+        if settings.background_mode == "fixed":
+            background_choices = []
+        else:
+            background_choices = list(self.manifest.names("background"))
+        # That's everything that decides what the comic looks like, so if
+        # we've drawn this exact comic before we can just send it again
+        encodings = ENCODING_MODES[settings.encoding]
+        budget = ctx.guild.filesize_limit
+        key = comic_key(
+            messages, characters, settings.font,
+            [settings.background_mode, settings.background_image, background_choices],
+            encodings, budget, RENDER_VERSION,
+            # So a sprite or background getting swapped out on disk doesn't
+            # keep serving comics drawn with the old one
+            asset_stamps=(
+                self.manifest.stamps("char", characters.values())
+                + self.manifest.stamps("font", [settings.font])
+                + self.manifest.stamps("background", background_choices or [settings.background_image])
+                )
+            )
+        loop = get_running_loop()
+        cached = await loop.run_in_executor(None, self.comic_cache.get, key)
+        if cached:
+            with timer.span("upload"):
+                await self._send_comic(ctx, settings, key, cached.data, cached.extension)
+            self._record_timings(ctx, timer, count=len(messages), encoding=cached.extension, cached=True)
+            return
+
+        submitted = perf_counter()
+
+        async def render():
+            timer.add("queue", perf_counter()-submitted)
+            # Nothing expensive happens until the scheduler lets us in, so a
+            # full queue turns people away before we've done any work
+            comic, layout = await loop.run_in_executor(
+                None, self._layout_comic, ctx.guild, messages, settings.font, timer
+                )
+            backgrounds = pick_backgrounds(
+                settings.background_mode, settings.background_image, background_choices,
+                len(layout.panels), seed=messages[-1].id
+                )
+            # All the actual drawing happens in the renderer's executor so we
+            # don't block the event loop (and every other cog) while PIL
+            # works. The encoder picks whichever allowed format comes out
+            # smallest, as long as it's under this guild's upload limit
+            with timer.span("render"):
+                encoded, spans = await self.renderer.render(
+                    layout, characters, backgrounds, settings.font,
+                    budget=budget, encodings=encodings
+                    )
+            for stage, seconds in spans.items():
+                timer.add(stage, seconds)
+            log.debug(
+                "Comic encoded as %s: %d bytes in %.0fms (tried %s)",
+                encoded.encoding, encoded.size, encoded.elapsed*1000, encoded.attempts
+                )
+            if encoded.fits:
+                # Store the comic data under the same name as the image, so
+                # we can debug any weird stuff rendered into comics
+                info = {
+                    "comic": comic,
+                    "characters": {str(id): char for id, char in characters.items()},
+                    "font": settings.font,
+                    "backgrounds": backgrounds,
+                    "encoding": encoded.encoding,
+                    "render_version": RENDER_VERSION
+                }
+                await loop.run_in_executor(
+                    None, self.comic_cache.put, key, encoded.data, encoded.extension, info
                     )
-                # left side buffer is rendered text width + text_buffer and find
-                # the difference between that and panel_width
-                (right_text_width, right_text_height) = draw.multiline_textsize(right_text, font=font)
-            # Left side character time
-            # We want to thumbnail the character to fit between the bottom of
-            # the left text and the bottom of the panel, taking into account
-            # buffers at the top and bottom
-            left_bottom_edge = left_text_height+(text_buffer*2)
-            char_height = panel_height-left_bottom_edge-(text_buffer*2)-right_text_height
-            if char_height < 150:
-                char_height = 150
-            char_width = 225-(text_buffer*2)
-            # Here we make a copy of the image so we can scale per-panel
-            # without worrying about destroying the char loaded into memory
-            thumb = char_img_map[comic[panel_count][0]['id']].copy()
-            thumb.thumbnail((char_width, char_height))
-            canvas.paste(thumb, (text_buffer, (panel_height*(panel_count+1))-thumb.height), mask=thumb)
-            # Now we draw the left side text, easy
-            # left side buffer
-            left_buffer = text_buffer
-            # top side buffer based on which panel we're in
-            top_buffer = text_buffer+(panel_height*panel_count)
-            # TODO: make this font pull from config instead of defaulting to
-            # our font object. Maybe make the text color configurable too?
-            draw.multiline_text((left_buffer, top_buffer), left_text, font=font, fill="white")
-
-            # Non-DRY code here, checking again if there's a right side of
-            # this panel
-            if len(comic[panel_count]) == 1 or not comic[panel_count][1]['text']:
-                continue
-
-            # And then we need to draw the right size text, giving it a top
-            # buffer equal to the height of the left text + 10 + text_buffer
-            left_buffer = panel_width - (right_text_width+text_buffer)
-            # top side buffer should be the same, but add previous text height and text_buffer and an extra 20
-            top_buffer = top_buffer+left_text_height+text_buffer
-            # Time for right side char
-            thumb = char_img_map[comic[panel_count][1]['id']].copy()
-            thumb.thumbnail((char_width, char_height))
-            thumb = ImageOps.mirror(thumb)
-            left_char_buffer = panel_width-(text_buffer+thumb.width)
-            canvas.paste(thumb, (left_char_buffer, (panel_height*(panel_count+1))-thumb.height), mask=thumb)
-            draw.multiline_text((left_buffer, top_buffer), right_text, font=font, fill="white")
-            # Now we need to draw a line to separate panels
-            # TODO: don't draw this line on the last panel
-            draw.line([(0, bottom_edge-1), (panel_width, bottom_edge-1)], width=4, fill="black")
-        # Write the Image object to our BytesIO file-in-memory object
-        canvas.save(canvas_bytes, format="PNG")
+            return encoded
+
+        # The scheduler decides when we get to render. If someone's already
+        # asked for this exact comic we just wait for theirs.
+        try:
+            ticket = self.scheduler.submit(ctx.guild.id, key, render)
+        except QueueFull:
+            await ctx.send("I've got too many comics to draw for this server already, try again in a bit.")
+            return
+        if ticket.position > 0:
+            await ctx.send(f"Busy, you're #{ticket.position} in line.")
+        encoded = await ticket.result()
+        if not encoded.fits:
+            await ctx.send("That comic came out too big to post, try fewer messages?")
+            return
+        with timer.span("upload"):
+            await self._send_comic(ctx, settings, key, encoded.data, encoded.extension)
+        self._record_timings(ctx, timer, count=len(messages), encoding=encoded.encoding, cached=False)
+
+    def _record_timings(self, ctx, timer, **details):
+        if self.timing_enabled:
+            self.stats.record(ctx.guild.id, timer.finish(), **details)
+
+    @weeed.command()
+    async def stats(self, ctx: commands.Context):
+        """Shows how long each stage of making a comic has been taking in this guild."""
+        summary = self.stats.summary(ctx.guild.id)
+        if not summary:
+            state = "on" if self.timing_enabled else "off (see `weeed set timing`)"
+            await ctx.send(f"No comic timings for this guild yet. Timing is {state}.")
+            return
+        lines = [f"{'stage':<9} {'n':>4} {'p50':>8} {'p95':>8} {'p99':>8}"]
+        for stage, (samples, p50, p95, p99) in summary.items():
+            lines.append(f"{stage:<9} {samples:>4} {p50*1000:>6.0f}ms {p95*1000:>6.0f}ms {p99*1000:>6.0f}ms")
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    async def _send_comic(self, ctx, settings, key, data, extension):
         # Send the file away~~
-        # TODO: make the filename a unique hash or something so that we can
-        # also store comic data under the same name with a different extension
-        # This would let us debug any weird stuff rendered into comics.
-        canvas_bytes.seek(0)
+        # The filename is the comic's cache key, the same name its comic data
+        # is stored under
         await ctx.send(
-            content=comic_text, file=discord.File(
-                canvas_bytes,
-                filename="comic.png"
+            content=settings.comic_text, file=discord.File(
+                BytesIO(data),
+                filename=f"{key[:16]}.{extension}"
                 )
             )